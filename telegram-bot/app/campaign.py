@@ -2,7 +2,7 @@ import time
 from datetime import datetime, timedelta
 from html import escape as _html_escape
 from pathlib import Path
-from typing import Iterable, Literal, Optional, TypedDict
+from typing import Any, Iterable, Literal, Optional, TypedDict
 import re
 from urllib.parse import quote_plus
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
@@ -23,7 +23,7 @@ from .text_utils import (
     truncate,
 )
 from .log_buffer import log
-from .pix_payment import PIX_PENDING_SET
+from .pix_payment import PIX_PENDING_ZSET
 from .funnel_metrics import record_funnel_event
 
 MEDIA_DIR = Path(__file__).resolve().parent / "media"
@@ -420,11 +420,17 @@ def mark_unpaid(user_id: int, chat_id: int, reset_cycle: bool = True) -> None:
         redis.hset(key, mapping=mapping)
 
 
-def mark_paid(user_id: int) -> None:
+def mark_paid(user_id: int, pipe: Any = None) -> None:
+    """Com `pipe`, só enfileira no pipeline do chamador (sync ou asyncio)."""
+    if pipe is not None:
+        pipe.hset(_user_key(user_id), mapping={"paid": "1"})
+        pipe.zrem(DUE_ZSET_KEY, str(user_id))
+        pipe.zrem(PIX_PENDING_ZSET, str(user_id))
+        return
     redis.hset(_user_key(user_id), mapping={"paid": "1"})
     redis.zrem(DUE_ZSET_KEY, str(user_id))
     try:
-        redis.srem(PIX_PENDING_SET, str(user_id))
+        redis.zrem(PIX_PENDING_ZSET, str(user_id))
     except Exception:
         pass
 
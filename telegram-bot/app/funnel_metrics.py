@@ -1,21 +1,33 @@
 import json
 import time
-from datetime import datetime
 from typing import Any
 
-from .redis_client import redis
+from .redis_client import aredis, redis
 
 FUNNEL_EVENTS_KEY = "tg:funnel:events"
 FUNNEL_COUNTERS_KEY = "tg:funnel:counters"
 FUNNEL_DAY_PREFIX = "tg:funnel:day:"
+# SET com os nomes das chaves diárias já escritas (reset sem SCAN no keyspace).
+FUNNEL_DAY_INDEX_KEY = "tg:funnel:day:index"
 
 
 def _day_key(ts: int) -> str:
-    day = datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d")
+    day = time.strftime("%Y-%m-%d", time.gmtime(ts))
     return f"{FUNNEL_DAY_PREFIX}{day}"
 
 
-def record_funnel_event(event: str, user_id: int | None = None, amount: float | None = None, **extra: Any) -> None:
+def record_funnel_event(
+    event: str,
+    user_id: int | None = None,
+    amount: float | None = None,
+    pipe: Any = None,
+    **extra: Any,
+) -> None:
+    """
+    Registra o evento (lista recente + contadores global/dia) num único pipeline.
+    Com `pipe`, só enfileira os comandos no pipeline do chamador (sync ou asyncio),
+    que fica responsável pelo execute.
+    """
     ts = int(time.time())
     payload: dict[str, Any] = {
         "ts": ts,
@@ -29,20 +41,23 @@ def record_funnel_event(event: str, user_id: int | None = None, amount: float |
         payload.update(extra)
 
     raw = json.dumps(payload, ensure_ascii=False)
-    try:
-        redis.lpush(FUNNEL_EVENTS_KEY, raw)
-        redis.ltrim(FUNNEL_EVENTS_KEY, 0, 1999)
-    except Exception:
-        pass
-
-    try:
-        redis.hincrby(FUNNEL_COUNTERS_KEY, "events_total", 1)
-        redis.hincrby(FUNNEL_COUNTERS_KEY, event, 1)
-        redis.hincrby(_day_key(ts), "events_total", 1)
-        redis.hincrby(_day_key(ts), event, 1)
-        redis.expire(_day_key(ts), 60 * 24 * 60 * 60)  # 60 days
-    except Exception:
-        pass
+    day_key = _day_key(ts)
+    own = pipe is None
+    if own:
+        pipe = redis.pipeline(transaction=False)
+    pipe.lpush(FUNNEL_EVENTS_KEY, raw)
+    pipe.ltrim(FUNNEL_EVENTS_KEY, 0, 1999)
+    pipe.hincrby(FUNNEL_COUNTERS_KEY, "events_total", 1)
+    pipe.hincrby(FUNNEL_COUNTERS_KEY, event, 1)
+    pipe.hincrby(day_key, "events_total", 1)
+    pipe.hincrby(day_key, event, 1)
+    pipe.expire(day_key, 60 * 24 * 60 * 60)  # 60 days
+    pipe.sadd(FUNNEL_DAY_INDEX_KEY, day_key)
+    if own:
+        try:
+            pipe.execute()
+        except Exception:
+            pass
 
 
 def get_funnel_counters() -> dict[str, str]:
@@ -58,3 +73,27 @@ def get_day_counters_utc() -> dict[str, str]:
     except Exception:
         return {}
 
+
+def get_funnel_snapshot(events_limit: int = 100) -> tuple[dict[str, str], dict[str, str], list[str]]:
+    """Contadores globais, contadores do dia (UTC) e eventos recentes em um único round trip."""
+    try:
+        counters, day, events = _queue_snapshot(redis.pipeline(transaction=False), events_limit).execute()
+    except Exception:
+        return {}, {}, []
+    return counters or {}, day or {}, events or []
+
+
+async def aget_funnel_snapshot(events_limit: int = 100) -> tuple[dict[str, str], dict[str, str], list[str]]:
+    """get_funnel_snapshot no client asyncio (dashboard do FastAPI)."""
+    try:
+        counters, day, events = await _queue_snapshot(aredis.pipeline(transaction=False), events_limit).execute()
+    except Exception:
+        return {}, {}, []
+    return counters or {}, day or {}, events or []
+
+
+def _queue_snapshot(pipe: Any, events_limit: int) -> Any:
+    pipe.hgetall(FUNNEL_COUNTERS_KEY)
+    pipe.hgetall(_day_key(int(time.time())))
+    pipe.lrange(FUNNEL_EVENTS_KEY, 0, events_limit - 1)
+    return pipe
@@ -1,7 +1,7 @@
 import io
 import threading
+import time
 from collections import deque
-from datetime import datetime
 from typing import Iterable
 
 _lock = threading.Lock()
@@ -10,7 +10,7 @@ _buffer: deque[str] = deque(maxlen=400)  # keep last ~400 lines
 
 def log(*parts: object) -> None:
     msg = " ".join(str(p) for p in parts)
-    ts = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
     line = f"{ts} {msg}"
     with _lock:
         _buffer.append(line)
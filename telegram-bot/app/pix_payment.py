@@ -1,7 +1,7 @@
 import hashlib
 import time
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
-from typing import Optional
+from typing import Any, Optional
 
 import httpx
 
@@ -17,19 +17,25 @@ from .redis_client import redis
 PIX_KEY_PREFIX = "tg:pix:"
 PIX_ERR_PREFIX = "tg:pixerr:"
 PIX_IDENTIFIER_MAP_KEY = "tg:pix:identifier_map"
-PIX_PENDING_SET = "tg:pix:pending"
-
-_PAID_STATUSES = {"PAID", "COMPLETE", "OK"}
-_PENDING_STATUSES = {"UNPAID", "OPEN", "PENDING"}
+# ZSET user_id -> timestamp da próxima consulta ao gateway (polling com backoff).
+PIX_PENDING_ZSET = "tg:pix:pending_due"
+# SET antigo (sem agendamento); migrado para o ZSET no boot do worker.
+PIX_PENDING_LEGACY_SET = "tg:pix:pending"
+PIX_POLL_MIN_SECONDS = 20
+PIX_POLL_MAX_SECONDS = 600
+
+_PAID_STATUSES = frozenset({"PAID", "COMPLETE", "OK"})
+_PENDING_STATUSES = frozenset({"UNPAID", "OPEN", "PENDING"})
+_STATUS_MAP: dict[str, str] = {
+    "": "PENDING",
+    **{k: "OK" for k in _PAID_STATUSES},
+    **{k: "PENDING" for k in _PENDING_STATUSES},
+}
 
 
 def _normalize_gateway_status(raw: str) -> str:
     s = (raw or "").upper()
-    if s in _PAID_STATUSES:
-        return "OK"
-    if s in _PENDING_STATUSES or not s:
-        return "PENDING"
-    return s
+    return _STATUS_MAP.get(s, s)
 
 
 def _pix_key(user_id: int) -> str:
@@ -251,7 +257,7 @@ async def create_pix_payment(
                     pass
 
                 try:
-                    redis.sadd(PIX_PENDING_SET, str(user_id))
+                    redis.zadd(PIX_PENDING_ZSET, {str(user_id): time.time() + PIX_POLL_MIN_SECONDS})
                 except Exception:
                     pass
 
@@ -357,9 +363,52 @@ async def check_payment_status_by_identifier(identifier: str, user_id: Optional[
         return None
 
 
-def mark_payment_confirmed(user_id: int) -> None:
-    """Marca o pagamento como confirmado (usado pelo callback/webhook)."""
-    redis.hset(_pix_key(user_id), "status", "OK")
+def mark_payment_confirmed(user_id: int, pipe: Any = None) -> None:
+    """
+    Marca o pagamento como confirmado (usado pelo callback/webhook).
+    Com `pipe`, só enfileira no pipeline do chamador (sync ou asyncio).
+    """
+    (pipe if pipe is not None else redis).hset(_pix_key(user_id), "status", "OK")
+
+
+def next_poll_delay(created_at: Optional[str]) -> int:
+    """
+    Backoff do polling: espera proporcional à idade do pagamento (20s, 40s, 80s...),
+    limitada a PIX_POLL_MAX_SECONDS. Sem created_at, usa o intervalo mínimo.
+    """
+    if not created_at:
+        return PIX_POLL_MIN_SECONDS
+    try:
+        age = int(time.time()) - int(created_at)
+    except ValueError:
+        return PIX_POLL_MIN_SECONDS
+    return min(PIX_POLL_MAX_SECONDS, max(PIX_POLL_MIN_SECONDS, age))
+
+
+PIX_PENDING_MIGRATE_BATCH = 500
+
+
+def migrate_legacy_pending() -> int:
+    """
+    Move os user_ids do SET antigo para o ZSET (devidos agora). Idempotente.
+    Chamado a cada rodada do polling: web antigo ainda no ar pode seguir dando SADD no SET.
+    SPOP retira os membros atomicamente: SADD concorrente fica no SET para a próxima rodada,
+    em vez de sumir num DEL entre a leitura e a limpeza.
+    """
+    moved = 0
+    while True:
+        members = redis.spop(PIX_PENDING_LEGACY_SET, PIX_PENDING_MIGRATE_BATCH)
+        if not members:
+            return moved
+        try:
+            redis.zadd(PIX_PENDING_ZSET, {uid: time.time() for uid in members}, nx=True)
+        except Exception:
+            # devolve ao SET legado para não perder ninguém; próxima rodada tenta de novo
+            redis.sadd(PIX_PENDING_LEGACY_SET, *members)
+            raise
+        moved += len(members)
+        if len(members) < PIX_PENDING_MIGRATE_BATCH:
+            return moved
 
 
 def get_pix_code(user_id: int) -> Optional[str]:
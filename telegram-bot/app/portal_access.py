@@ -2,7 +2,7 @@ import secrets
 import time
 from typing import Any, Dict, Optional
 
-from .redis_client import redis
+from .redis_client import aredis, redis
 from .tracking import get_utms
 
 KEY_PREFIX = "tg:portal:key:"
@@ -27,10 +27,7 @@ def save_access_key(access_key: str, user_id: int) -> None:
     redis.expire(_key_redis(access_key), KEY_TTL_SECONDS)
 
 
-def get_access_info(access_key: str) -> Optional[Dict[str, Any]]:
-    if access_key in DEV_FIXED_KEYS:
-        return {"user_id": 0, "created_at": str(int(time.time()))}
-    data = redis.hgetall(_key_redis(access_key))
+def _parse_access_info(data: Dict[str, str]) -> Optional[Dict[str, Any]]:
     if not data:
         return None
     user_id = data.get("user_id")
@@ -40,6 +37,19 @@ def get_access_info(access_key: str) -> Optional[Dict[str, Any]]:
     }
 
 
+def get_access_info(access_key: str) -> Optional[Dict[str, Any]]:
+    if access_key in DEV_FIXED_KEYS:
+        return {"user_id": 0, "created_at": str(int(time.time()))}
+    return _parse_access_info(redis.hgetall(_key_redis(access_key)))
+
+
+async def aget_access_info(access_key: str) -> Optional[Dict[str, Any]]:
+    """get_access_info no client asyncio (handlers do FastAPI)."""
+    if access_key in DEV_FIXED_KEYS:
+        return {"user_id": 0, "created_at": str(int(time.time()))}
+    return _parse_access_info(await aredis.hgetall(_key_redis(access_key)))
+
+
 def get_access_utms(access_key: str) -> Dict[str, str]:
     info = get_access_info(access_key)
     if not info or not info.get("user_id"):
@@ -1,4 +1,5 @@
 from redis import ConnectionPool, Redis
+from redis.asyncio import BlockingConnectionPool as AsyncBlockingConnectionPool, Redis as AsyncRedis
 
 from .config import REDIS_URL
 
@@ -14,3 +15,35 @@ _pool = ConnectionPool.from_url(
 )
 redis = Redis(connection_pool=_pool)
 
+# Pool asyncio para os handlers async do FastAPI — o event loop segue atendendo
+# outras requisições enquanto espera o Redis. Blocking: com as 50 conexões em uso
+# o comando espera uma livre (até `timeout`) em vez de falhar com "Too many connections".
+_async_pool = AsyncBlockingConnectionPool.from_url(
+    REDIS_URL,
+    decode_responses=True,
+    max_connections=50,
+    timeout=10,
+    socket_connect_timeout=5,
+    socket_timeout=5,
+    retry_on_timeout=True,
+)
+aredis = AsyncRedis(connection_pool=_async_pool)
+
+# Client asyncio sem decode: a fila de updates é consumida como bytes crus
+# (o orjson do worker decodifica direto, sem passar por str).
+_async_raw_pool = AsyncBlockingConnectionPool.from_url(
+    REDIS_URL,
+    decode_responses=False,
+    max_connections=4,
+    timeout=10,
+    socket_connect_timeout=5,
+    socket_timeout=5,
+    retry_on_timeout=True,
+)
+aredis_raw = AsyncRedis(connection_pool=_async_raw_pool)
+
+
+async def close_async_pools() -> None:
+    """Desconecta os pools asyncio (shutdown do app)."""
+    await _async_pool.disconnect()
+    await _async_raw_pool.disconnect()
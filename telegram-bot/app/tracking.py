@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import hashlib
 import json
@@ -16,7 +17,7 @@ from .config import (
     UTMIFY_API_TOKEN,
     UTMIFY_API_URL,
 )
-from .redis_client import redis
+from .redis_client import aredis, redis
 from .log_buffer import log
 
 UTM_KEY_PREFIX = "tg:utm:"
@@ -141,6 +142,12 @@ def get_utms(user_id: int) -> Dict[str, str]:
     return data or {}
 
 
+async def aget_utms(user_id: int) -> Dict[str, str]:
+    """get_utms no client asyncio (handlers do FastAPI)."""
+    data = await aredis.hgetall(_utm_key(user_id))
+    return data or {}
+
+
 def _tracking_parameters(utms: Dict[str, str]) -> Dict[str, Optional[str]]:
     keys = [
         "src",
@@ -364,3 +371,41 @@ async def send_facebook_event(
     except Exception as e:
         log("[FACEBOOK] ERRO", type(e).__name__, str(e))
         return
+
+
+async def send_paid_tracking(
+    *,
+    order_id: str,
+    amount: float,
+    currency: str,
+    customer: Dict[str, str],
+    utms: Dict[str, str],
+    log_tag: str,
+    **utmify_kw: Any,
+) -> None:
+    """
+    Pedido pago na UTMify + Purchase no Facebook CAPI, em paralelo (hosts independentes).
+    Falha de um lado é logada com `log_tag` e não impede o outro.
+    """
+    results = await asyncio.gather(
+        send_to_utmify_order(
+            order_id=order_id,
+            status="paid",
+            amount=amount,
+            customer=customer,
+            utms=utms,
+            **utmify_kw,
+        ),
+        send_facebook_event(
+            event_name="Purchase",
+            event_id=order_id,
+            amount=amount,
+            currency=currency,
+            customer=customer,
+            utms=utms,
+        ),
+        return_exceptions=True,
+    )
+    for target, res in zip(("utmify", "facebook"), results):
+        if isinstance(res, Exception):
+            log(f"{log_tag} TRACKING ERRO", target, type(res).__name__, str(res))
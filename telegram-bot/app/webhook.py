@@ -1,20 +1,36 @@
-import json
+import asyncio
 import os
 import hmac
+import gzip
 import hashlib
+import mimetypes
+import string
+import time
+from contextlib import asynccontextmanager
 from pathlib import Path
-from datetime import datetime
-from html import escape as html_escape
-from fastapi import FastAPI, Request, Header, HTTPException
-from fastapi.responses import RedirectResponse, HTMLResponse, FileResponse
-from redis import Redis
+from fastapi import BackgroundTasks, FastAPI, Request, Header, HTTPException
+from fastapi.staticfiles import StaticFiles
+from fastapi.responses import (
+    HTMLResponse,
+    ORJSONResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
 from typing import Optional
 
+import httpx
+import orjson
+from aiogram import Bot
+
 from .log_buffer import log
 
 from .config import (
+    BASE_URL,
+    BOT_TOKEN,
     WEBHOOK_SECRET,
-    REDIS_URL,
     QUEUE_KEY,
     BOT_DEEPLINK_BASE,
     BOT_PUBLIC_URL,
@@ -22,76 +38,201 @@ from .config import (
     PORTAL_BASE_URL,
     ADMIN_DASHBOARD_TOKEN,
     STRIPE_WEBHOOK_SECRET,
+    STRIPE_SECRET_KEY,
+    DEFAULT_CLIENT_DOCUMENT,
+    DEFAULT_CLIENT_EMAIL,
+    DEFAULT_CLIENT_NAME,
+    DEFAULT_CLIENT_PHONE,
 )
-from .tracking import save_utms_token
+from .tracking import aget_utms, save_utms_token, send_paid_tracking
 from .portal_content import DEFAULT_MIN_AGE, DEFAULT_MAX_AGE, FAMOUS_PEOPLE, VIDEOS
-from .portal_access import get_access_info, get_access_utms
-from .pix_payment import create_pix_payment, check_payment_status_by_identifier
+from .portal_access import aget_access_info
+from .pix_payment import create_pix_payment, check_payment_status_by_identifier, mark_payment_confirmed
+from .campaign import mark_paid
+from .access_delivery import deliver_access_if_needed
 from .log_buffer import log
-from .pix_payment import PIX_PENDING_SET
-from .redis_client import redis
+from .pix_payment import PIX_PENDING_ZSET
+from .redis_client import aredis, close_async_pools
 from .funnel_metrics import (
-    get_funnel_counters,
-    get_day_counters_utc,
+    aget_funnel_snapshot,
     record_funnel_event,
     FUNNEL_EVENTS_KEY,
     FUNNEL_COUNTERS_KEY,
-    FUNNEL_DAY_PREFIX,
+    FUNNEL_DAY_INDEX_KEY,
 )
 
-app = FastAPI()
+# Mídia (jpeg/png/mp4) já vem comprimida: gzip não reduz nada e só gasta CPU no event loop.
+PORTAL_MEDIA_PATH_PREFIX = "/portal/media/"
+
+
+class _GZipExceptMedia:
+    """GZipMiddleware padrão para tudo, exceto /portal/media/ (servido direto, com Content-Length)."""
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 500, compresslevel: int = 9) -> None:
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size, compresslevel=compresslevel)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and scope["path"].startswith(PORTAL_MEDIA_PATH_PREFIX):
+            await self.app(scope, receive, send)
+            return
+        await self.gzip(scope, receive, send)
+
+
+# Bot compartilhado para entregas disparadas pelos callbacks (reaproveita a sessão HTTP/TLS).
+_BOT = None
+
+
+def _get_bot():
+    global _BOT
+    if _BOT is None:
+        _BOT = Bot(BOT_TOKEN)
+    return _BOT
+
+
+@asynccontextmanager
+async def _lifespan(_app: FastAPI):
+    yield
+    # Shutdown: fecha a sessão do Bot compartilhado e os pools asyncio do Redis.
+    if _BOT is not None:
+        await _BOT.session.close()
+    await close_async_pools()
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=_lifespan)
+# HTML do portal/dashboards e JSON comprimem bem; mídia fica de fora (ver acima).
+app.add_middleware(_GZipExceptMedia, minimum_size=512, compresslevel=5)
 
 UPSELL_KEY_PREFIX = "tg:upsell:key:"
 UPSELL_IDENTIFIER_MAP_KEY = "tg:upsell:identifier_map"
 UPSELL_EVENTS_KEY = "tg:upsell:events"
 UPSELL_INDEX_ZSET = "tg:upsell:index"
+UPSELL_TTL_SECONDS = 30 * 24 * 60 * 60
 
 
 def _upsell_key(access_key: str) -> str:
     return f"{UPSELL_KEY_PREFIX}{access_key}"
 
 
+# Mesmo resultado de html.escape(s, quote=True), em uma passada só (str.translate em C).
+_HTML_ESCAPE_TABLE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"})
+
+
+def _esc(value: object) -> str:
+    return str(value).translate(_HTML_ESCAPE_TABLE)
+
+
+def _minify_html(html: str) -> str:
+    """Remove indentação e linhas vazias (mantém as quebras: seguro para os // do JS inline)."""
+    return "\n".join(stripped for line in html.splitlines() if (stripped := line.strip()))
+
+
 def _iso_now() -> str:
-    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
+    return time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime())
 
 
-def _upsell_event(event: str, payload: dict) -> None:
+async def _upsell_event(event: str, payload: dict, pipe=None) -> None:
+    """Registra evento de upsell (LPUSH + LTRIM). Com `pipe`, só enfileira no pipeline do chamador."""
     rec = {
         "ts": _iso_now(),
         "event": event,
         **payload,
     }
     try:
-        redis.lpush(UPSELL_EVENTS_KEY, json.dumps(rec, ensure_ascii=False))
-        redis.ltrim(UPSELL_EVENTS_KEY, 0, 999)
+        p = pipe if pipe is not None else aredis.pipeline(transaction=False)
+        p.lpush(UPSELL_EVENTS_KEY, orjson.dumps(rec))
+        p.ltrim(UPSELL_EVENTS_KEY, 0, 999)
+        if pipe is None:
+            await p.execute()
     except Exception:
         pass
 
 
+ACCESS_CACHE_TTL_SECONDS = 30
+_ACCESS_CACHE_MAX_ITEMS = 10000
+_ACCESS_CACHE: dict[str, tuple[float, dict]] = {}
+
+
+async def _cached_access_info(key: str) -> Optional[dict]:
+    """get_access_info com cache curto em memória (o portal faz polling em /portal/check)."""
+    now = time.monotonic()
+    hit = _ACCESS_CACHE.get(key)
+    if hit and now - hit[0] < ACCESS_CACHE_TTL_SECONDS:
+        return hit[1]
+    info = await aget_access_info(key)
+    if not info:
+        _ACCESS_CACHE.pop(key, None)
+        return None
+    if key not in _ACCESS_CACHE and len(_ACCESS_CACHE) >= _ACCESS_CACHE_MAX_ITEMS:
+        _ACCESS_CACHE.pop(next(iter(_ACCESS_CACHE)))
+    _ACCESS_CACHE[key] = (now, info)
+    return info
+
+
+# Digest do token admin calculado uma vez; a comparação é sempre entre 32 bytes
+# (tempo constante e independente do tamanho do token recebido).
+_ADMIN_TOKEN_DIGEST = hashlib.sha256(ADMIN_DASHBOARD_TOKEN.encode("utf-8")).digest() if ADMIN_DASHBOARD_TOKEN else None
+
+
 def _upsell_auth(token: Optional[str]) -> None:
-    if not ADMIN_DASHBOARD_TOKEN:
+    if _ADMIN_TOKEN_DIGEST is None:
         raise HTTPException(status_code=403, detail="ADMIN_DASHBOARD_TOKEN não configurado")
-    if token != ADMIN_DASHBOARD_TOKEN:
+    if not token or not hmac.compare_digest(hashlib.sha256(token.encode("utf-8")).digest(), _ADMIN_TOKEN_DIGEST):
         raise HTTPException(status_code=401, detail="Token inválido")
 
 
+_PAID_STATUSES = frozenset({"OK", "COMPLETED", "TRANSACTION_PAID", "PAID", "APPROVED"})
+_PENDING_STATUSES = frozenset({"PENDING", "TRANSACTION_CREATED", "WAITING_PAYMENT", "CREATED", "PROCESSING", "OPEN", "UNPAID"})
+_FAILED_STATUSES = frozenset({"FAILED", "CANCELED", "CANCELLED", "EXPIRED", "REFUNDED", "CHARGEBACK", "ERROR"})
+_STATUS_MAP: dict[str, str] = {
+    **{k: "OK" for k in _PAID_STATUSES},
+    **{k: "PENDING" for k in _PENDING_STATUSES},
+    **{k: k for k in _FAILED_STATUSES},
+}
+
+
 def _map_gateway_status(raw: Optional[str]) -> str:
     """Normaliza status de qualquer gateway para formato interno."""
     s = (raw or "").upper()
-    paid = {"OK", "COMPLETED", "TRANSACTION_PAID", "PAID", "APPROVED"}
-    pending = {"PENDING", "TRANSACTION_CREATED", "WAITING_PAYMENT", "CREATED", "PROCESSING", "OPEN", "UNPAID"}
-    failed = {"FAILED", "CANCELED", "CANCELLED", "EXPIRED", "REFUNDED", "CHARGEBACK", "ERROR"}
-    if s in paid:
-        return "OK"
-    if s in pending or not s:
+    if not s:
         return "PENDING"
-    if s in failed:
-        return s
-    return s
+    return _STATUS_MAP.get(s, s)
+
+
+# Idempotência de callbacks: gateways reenviam o mesmo evento em retries.
+WEBHOOK_SEEN_KEY_PREFIX = "tg:webhook:seen:"
+# Stripe reenvia por até 3 dias; 7 dias cobre a janela inteira de retries.
+WEBHOOK_SEEN_TTL_SECONDS = 7 * 24 * 60 * 60
+
+
+async def _first_delivery(idem: str) -> bool:
+    """True na primeira vez que o evento chega (SET NX); False em reentregas."""
+    if not idem:
+        return True
+    return bool(await aredis.set(f"{WEBHOOK_SEEN_KEY_PREFIX}{idem}", "1", nx=True, ex=WEBHOOK_SEEN_TTL_SECONDS))
+
+
+async def _forget_delivery(idem: str) -> None:
+    """
+    Libera o marcador de `_first_delivery` quando o processamento não chegou ao fim,
+    para que a reentrega do gateway (retry / "resend event") seja processada de novo.
+    """
+    if not idem:
+        return
+    try:
+        await aredis.unlink(f"{WEBHOOK_SEEN_KEY_PREFIX}{idem}")
+    except Exception as e:
+        log("[WEBHOOK] erro liberando marcador", idem, type(e).__name__, str(e))
+
+
+def _first_str(d: dict, *keys: str) -> str:
+    """Primeiro valor não-vazio entre as chaves, como str ("" se nenhum)."""
+    for k in keys:
+        v = d.get(k)
+        if v:
+            return str(v)
+    return ""
 
-def get_redis() -> Redis:
-    # cria a conexão quando precisar (evita crash no import)
-    return Redis.from_url(REDIS_URL, decode_responses=True, socket_connect_timeout=3, socket_timeout=3)
 
 @app.get("/")
 async def health():
@@ -110,15 +251,11 @@ async def health():
 @app.get("/debug")
 async def debug():
     """Endpoint de debug para verificar status do serviço."""
-    from .config import BOT_TOKEN, BASE_URL, REDIS_URL, QUEUE_KEY
-    
-    r = get_redis()
-    
     try:
         # Tenta fazer ping no Redis
-        r.ping()
+        await aredis.ping()
         redis_status = "✅ Conectado"
-        queue_size = r.llen(QUEUE_KEY)
+        queue_size = await aredis.llen(QUEUE_KEY)
     except Exception as e:
         redis_status = f"❌ Erro: {str(e)}"
         queue_size = "N/A"
@@ -137,15 +274,15 @@ async def debug():
 async def admin_ops(token: Optional[str] = None, x_admin_token: Optional[str] = Header(default=None)):
     _upsell_auth(token or x_admin_token)
     try:
-        queue_size = redis.llen(QUEUE_KEY)
+        queue_size = await aredis.llen(QUEUE_KEY)
     except Exception:
         queue_size = -1
     try:
-        pix_pending = redis.scard(PIX_PENDING_SET)
+        pix_pending = await aredis.zcard(PIX_PENDING_ZSET)
     except Exception:
         pix_pending = -1
     try:
-        followup_due = redis.zcard("tg:campaign:due")
+        followup_due = await aredis.zcard("tg:campaign:due")
     except Exception:
         followup_due = -1
     return {
@@ -157,9 +294,12 @@ async def admin_ops(token: Optional[str] = None, x_admin_token: Optional[str] =
 
 
 @app.get("/meta.json")
-async def meta_json():
+@app.head("/meta.json")
+async def meta_json(request: Request):
     # Evita ruído de 404 em scanners/preloads.
-    return {"ok": True}
+    return _cached_bytes_response(
+        request, _META_JSON_BYTES, _META_JSON_ETAG, "application/json", "public, max-age=86400"
+    )
 
 
 @app.get("/r")
@@ -183,18 +323,8 @@ async def head_r():
     return {"ok": True}
 
 
-@app.get("/p", response_class=HTMLResponse)
-async def pixel_page(token: str):
-    """
-    Intermediate page: fires FB Pixel PageView, filters bots via JS challenge,
-    then redirects real users (including mobile) to Telegram deeplink.
-    Bots without JS/touch/mouse never get redirected.
-    """
-    if not token:
-        return HTMLResponse("<html><body>Missing token</body></html>", status_code=400)
-
-    deeplink = f"{BOT_DEEPLINK_BASE}{token}"
-    html = f"""<!doctype html>
+def _render_pixel_page(deeplink: str) -> str:
+    return f"""<!doctype html>
 <html>
   <head>
     <meta charset="utf-8" />
@@ -221,14 +351,16 @@ async def pixel_page(token: str):
       s.parentNode.insertBefore(t,s)}}(window, document,'script',
       'https://connect.facebook.net/en_US/fbevents.js');
       fbq('init', '{FACEBOOK_PIXEL_BROWSER_ID}');
-      fbq('track', 'PageView');
+      // Mesmo eventID no fbq e no beacon: o Facebook deduplica e conta um PageView só.
+      var eid = 'pv.' + Date.now() + '.' + Math.random().toString(36).slice(2, 10);
+      fbq('track', 'PageView', {{}}, {{eventID: eid}});
 
       // ── Bot filter: only redirect if real browser environment ──
       var passed = false;
       function go() {{
         if (passed) return;
         passed = true;
-        window.location.href = '{deeplink}';
+        window.location.replace('{deeplink}');
       }}
 
       // Real browsers: have screen dimensions, support touch or mouse events
@@ -237,8 +369,11 @@ async def pixel_page(token: str):
         var h = window.innerHeight || screen.height || 0;
         // Basic sanity: real device has >0 dimensions and a navigator
         if (w > 0 && h > 0 && navigator.userAgent && navigator.userAgent.length > 10) {{
-          // Pass — schedule redirect (short delay for pixel to fire)
-          setTimeout(go, 500);
+          // Pass — beacon guarantees the PageView is flushed on unload, so redirect right away
+          if (navigator.sendBeacon) {{
+            navigator.sendBeacon('https://www.facebook.com/tr?id={FACEBOOK_PIXEL_BROWSER_ID}&ev=PageView&noscript=1&eid=' + encodeURIComponent(eid));
+          }}
+          go();
         }} else {{
           // Likely bot — show fallback link but don't auto-redirect
           document.getElementById('fallback').style.display = 'block';
@@ -274,15 +409,34 @@ async def pixel_page(token: str):
     </div>
   </body>
 </html>"""
-    return HTMLResponse(html)
 
 
-@app.get("/portal", response_class=HTMLResponse)
-async def portal_page():
+# /p só varia no deeplink: renderiza uma vez com um marcador e guarda os pedaços em bytes.
+_PIXEL_PAGE_MARK = "\x00"
+_PIXEL_PAGE_PARTS = [
+    part.encode("utf-8") for part in _minify_html(_render_pixel_page(_PIXEL_PAGE_MARK)).split(_PIXEL_PAGE_MARK)
+]
+
+
+@app.get("/p", response_class=HTMLResponse)
+async def pixel_page(token: str):
+    """
+    Intermediate page: fires FB Pixel PageView, filters bots via JS challenge,
+    then redirects real users (including mobile) to Telegram deeplink.
+    Bots without JS/touch/mouse never get redirected.
+    """
+    if not token:
+        return HTMLResponse("<html><body>Missing token</body></html>", status_code=400)
+
+    deeplink = f"{BOT_DEEPLINK_BASE}{token}"
+    return HTMLResponse(deeplink.encode("utf-8").join(_PIXEL_PAGE_PARTS))
+
+
+def _render_portal_html() -> str:
     """
     Página do portal (mobile-friendly) com popup de chave.
     """
-    html = f"""<!doctype html>
+    return f"""<!doctype html>
 <html>
   <head>
     <meta charset="utf-8" />
@@ -577,73 +731,173 @@ async def portal_page():
     </script>
   </body>
 </html>"""
-    return HTMLResponse(html)
 
 
-MEDIA_DIR = Path(__file__).resolve().parent / "media"
+def _etag(data: bytes) -> str:
+    return f'"{hashlib.blake2b(data, digest_size=8).hexdigest()}"'
 
 
-@app.get("/portal/media/{filename:path}")
-async def portal_media(filename: str):
-    """Serve arquivos da pasta app/media para thumbnails do portal."""
-    base = MEDIA_DIR.resolve()
-    path = (MEDIA_DIR / filename).resolve()
-    try:
-        path.relative_to(base)
-    except ValueError:
-        raise HTTPException(status_code=404, detail="Not found")
-    if not path.is_file():
-        raise HTTPException(status_code=404, detail="Not found")
-    return FileResponse(path)
+def _gzip_variant(body: bytes) -> tuple[bytes, str]:
+    """Versão gzip pré-comprimida (nível máximo, uma vez no boot) + ETag próprio."""
+    gz = gzip.compress(body, compresslevel=9, mtime=0)
+    return gz, _etag(gz)
 
 
-@app.get("/portal/content")
-async def portal_content():
-    return {
+def _cached_bytes_response(
+    request: Request,
+    body: bytes,
+    etag: str,
+    media_type: str,
+    cache_control: str,
+    gz: Optional[tuple[bytes, str]] = None,
+) -> Response:
+    """Resposta de conteúdo estático do processo com ETag/304 (e gzip pronto, se houver)."""
+    headers = {"Cache-Control": cache_control}
+    if gz is not None:
+        headers["Vary"] = "Accept-Encoding"
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            body, etag = gz
+            # Content-Encoding já definido: o GZipMiddleware não recomprime.
+            headers["Content-Encoding"] = "gzip"
+    headers["ETag"] = etag
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type=media_type, headers=headers)
+
+
+# Conteúdo fixo durante a vida do processo: renderiza/serializa uma vez no boot.
+_PORTAL_HTML_BYTES = _minify_html(_render_portal_html()).encode("utf-8")
+_PORTAL_HTML_ETAG = _etag(_PORTAL_HTML_BYTES)
+_PORTAL_HTML_GZ = _gzip_variant(_PORTAL_HTML_BYTES)
+_PORTAL_CONTENT_BYTES = orjson.dumps(
+    {
         "minAge": DEFAULT_MIN_AGE,
         "maxAge": DEFAULT_MAX_AGE,
         "people": FAMOUS_PEOPLE,
         "videos": [v.__dict__ for v in VIDEOS],
     }
+)
+_PORTAL_CONTENT_ETAG = _etag(_PORTAL_CONTENT_BYTES)
+_PORTAL_CONTENT_GZ = _gzip_variant(_PORTAL_CONTENT_BYTES)
+_META_JSON_BYTES = b'{"ok":true}'
+_META_JSON_ETAG = _etag(_META_JSON_BYTES)
+
+
+@app.get("/portal", response_class=HTMLResponse)
+@app.head("/portal")
+async def portal_page(request: Request):
+    return _cached_bytes_response(
+        request,
+        _PORTAL_HTML_BYTES,
+        _PORTAL_HTML_ETAG,
+        "text/html; charset=utf-8",
+        "public, max-age=60",
+        gz=_PORTAL_HTML_GZ,
+    )
+
+
+MEDIA_DIR = Path(__file__).resolve().parent / "media"
+# Arquivos até esse tamanho (thumbnails) ficam em memória; vídeos seguem do disco.
+MEDIA_CACHE_MAX_BYTES = 256 * 1024
+
+
+def _index_media_files() -> dict[str, Path]:
+    """Allowlist de arquivos servíveis montada no boot (evita resolve() por request)."""
+    return {
+        path.relative_to(MEDIA_DIR).as_posix(): path
+        for path in MEDIA_DIR.rglob("*")
+        if path.is_file() and not path.name.startswith(".")
+    }
+
+
+def _load_media_cache(files: dict[str, Path]) -> dict[str, tuple[bytes, str, str]]:
+    """Carrega as mídias pequenas uma vez no boot: {nome: (bytes, etag, content_type)}."""
+    cache: dict[str, tuple[bytes, str, str]] = {}
+    for name, path in files.items():
+        if path.stat().st_size > MEDIA_CACHE_MAX_BYTES:
+            continue
+        data = path.read_bytes()
+        etag = _etag(data)
+        content_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        cache[name] = (data, etag, content_type)
+    return cache
+
+
+_MEDIA_FILES = _index_media_files()
+_MEDIA = _load_media_cache(_MEDIA_FILES)
+# Arquivos grandes: StaticFiles cuida de ETag/Last-Modified e responde 304 sozinho.
+_MEDIA_STATIC = StaticFiles(directory=MEDIA_DIR, check_dir=False)
+
+
+@app.get(PORTAL_MEDIA_PATH_PREFIX + "{filename:path}")
+async def portal_media(filename: str, request: Request):
+    """Serve arquivos da pasta app/media para thumbnails do portal."""
+    entry = _MEDIA.get(filename)
+    if entry:
+        data, etag, content_type = entry
+        return _cached_bytes_response(request, data, etag, content_type, "public, max-age=86400")
+
+    if filename not in _MEDIA_FILES:
+        raise HTTPException(status_code=404, detail="Not found")
+    response = await _MEDIA_STATIC.get_response(filename, request.scope)
+    response.headers["Cache-Control"] = "public, max-age=86400"
+    return response
+
+
+@app.get("/portal/content")
+@app.head("/portal/content")
+async def portal_content(request: Request):
+    return _cached_bytes_response(
+        request,
+        _PORTAL_CONTENT_BYTES,
+        _PORTAL_CONTENT_ETAG,
+        "application/json",
+        "public, max-age=300, stale-while-revalidate=3600",
+        gz=_PORTAL_CONTENT_GZ,
+    )
 
 
 @app.get("/portal/verify")
 async def portal_verify(key: str):
-    info = get_access_info(key)
+    info = await _cached_access_info(key)
     if not info:
-        _upsell_event("portal_verify_invalid", {"key": key})
+        await _upsell_event("portal_verify_invalid", {"key": key})
         return {"ok": False}
-    _upsell_event("portal_verify_ok", {"key": key, "user_id": info.get("user_id")})
+    await _upsell_event("portal_verify_ok", {"key": key, "user_id": info.get("user_id")})
     return {"ok": True, "portal_link": f"{PORTAL_BASE_URL}?key={key}"}
 
 
 @app.post("/portal/upsell")
 async def portal_upsell(key: str):
-    info = get_access_info(key)
+    info = await _cached_access_info(key)
     if not info:
         return {"ok": False, "error": "invalid_key"}
 
     user_id = info["user_id"]
-    utms = get_access_utms(key)
     up_key = _upsell_key(key)
-    existing = redis.hgetall(up_key) or {}
-    now_ts_int = int(datetime.utcnow().timestamp())
+    # Só os campos da checagem de reuso (o hash pode ter campos grandes).
+    status_raw, created_raw, checkout_raw, pix_code_raw, identifier_existing = await aredis.hmget(
+        up_key, "status", "created_at", "checkout_url", "pix_code", "identifier"
+    )
+    now_ts_int = int(time.time())
     UPSELL_AMOUNT_GBP = 19.99
-    if existing:
-        status_existing = _map_gateway_status(existing.get("status"))
-        created = int(existing.get("created_at") or "0")
+    checkout_url = (checkout_raw or pix_code_raw or "").strip()
+    if checkout_url:
+        status_existing = _map_gateway_status(status_raw)
+        created = int(created_raw or "0")
         age = now_ts_int - created if created else 999999
-        checkout_url = (existing.get("checkout_url") or existing.get("pix_code") or "").strip()
-        if status_existing == "PENDING" and age <= 300 and checkout_url:
-            _upsell_event("upsell_reused", {"key": key, "user_id": user_id, "identifier": existing.get("identifier", "")})
+        if status_existing == "PENDING" and age <= 300:
+            await _upsell_event("upsell_reused", {"key": key, "user_id": user_id, "identifier": identifier_existing or ""})
             return {
                 "ok": True,
                 "code": checkout_url,
                 "checkout_url": checkout_url,
-                "identifier": existing.get("identifier", ""),
+                "identifier": identifier_existing or "",
                 "reused": True,
             }
     # Create Stripe checkout for upgrade (£19.99 GBP)
+    # user_id já veio do cache de acesso: busca as UTMs direto, sem reler a chave do portal.
+    utms = await aget_utms(user_id) if user_id else {}
     pix = await create_pix_payment(
         user_id=user_id,
         amount=UPSELL_AMOUNT_GBP,
@@ -655,12 +909,14 @@ async def portal_upsell(key: str):
     )
     if not pix:
         log("[PORTAL] upsell stripe error", {"key": key, "user_id": user_id})
-        _upsell_event("upsell_stripe_error", {"key": key, "user_id": user_id})
+        await _upsell_event("upsell_stripe_error", {"key": key, "user_id": user_id})
         return {"ok": False, "error": "stripe_error"}
     identifier = pix.get("identifier") or ""
     checkout_url = pix.get("checkout_url") or pix.get("code") or ""
     now_ts = str(now_ts_int)
-    redis.hset(
+    # Registro do upsell, mapa de identifier, índice e evento em um único round trip.
+    pipe = aredis.pipeline(transaction=False)
+    pipe.hset(
         up_key,
         mapping={
             "access_key": key,
@@ -675,12 +931,20 @@ async def portal_upsell(key: str):
             "updated_at": now_ts,
         },
     )
-    redis.expire(up_key, 30 * 24 * 60 * 60)
+    pipe.expire(up_key, UPSELL_TTL_SECONDS)
     if identifier:
-        redis.hset(UPSELL_IDENTIFIER_MAP_KEY, identifier, key)
-    redis.zadd(UPSELL_INDEX_ZSET, {key: int(now_ts)})
+        pipe.hset(UPSELL_IDENTIFIER_MAP_KEY, identifier, key)
+    pipe.zadd(UPSELL_INDEX_ZSET, {key: int(now_ts)})
+    # Hashes expiram em UPSELL_TTL_SECONDS: tira do índice o que já não existe,
+    # senão o top-200 do dashboard vai se enchendo de chaves mortas.
+    pipe.zremrangebyscore(UPSELL_INDEX_ZSET, "-inf", now_ts_int - UPSELL_TTL_SECONDS)
+    await _upsell_event(
+        "upsell_stripe_created",
+        {"key": key, "user_id": user_id, "identifier": identifier, "amount": UPSELL_AMOUNT_GBP},
+        pipe=pipe,
+    )
+    await pipe.execute()
     log("[PORTAL] upsell stripe ok", {"key": key, "user_id": user_id, "identifier": identifier})
-    _upsell_event("upsell_stripe_created", {"key": key, "user_id": user_id, "identifier": identifier, "amount": UPSELL_AMOUNT_GBP})
     return {
         "ok": True,
         "code": checkout_url,
@@ -691,30 +955,101 @@ async def portal_upsell(key: str):
 
 @app.get("/portal/check")
 async def portal_check(key: str):
-    info = get_access_info(key)
+    info = await _cached_access_info(key)
     if not info:
         return {"ok": False, "error": "invalid_key"}
     user_id = info["user_id"]
-    upsell_data = redis.hgetall(_upsell_key(key)) or {}
-    identifier = upsell_data.get("identifier") or ""
+    up_key = _upsell_key(key)
+    # Só os dois campos usados (o hash guarda checkout_url/pix_code, bem maiores).
+    identifier, stored_status = await aredis.hmget(up_key, "identifier", "status")
+    identifier = identifier or ""
     status = None
     if identifier:
         status = await check_payment_status_by_identifier(identifier, user_id=user_id)
     if not status:
-        status = upsell_data.get("status") or "PENDING"
+        status = stored_status or "PENDING"
     status = _map_gateway_status(status)
-    redis.hset(_upsell_key(key), mapping={"status": status, "updated_at": str(int(datetime.utcnow().timestamp()))})
+    now_ts = str(int(time.time()))
+    mapping = {"status": status, "updated_at": now_ts}
+    if status == "OK":
+        mapping["paid_at"] = now_ts
+    # Status + evento de pagamento (se houver) num único round trip.
+    pipe = aredis.pipeline(transaction=False)
+    pipe.hset(up_key, mapping=mapping)
     if status == "OK":
-        redis.hset(_upsell_key(key), "paid_at", str(int(datetime.utcnow().timestamp())))
-        _upsell_event("upsell_paid_check", {"key": key, "user_id": user_id, "identifier": identifier})
+        await _upsell_event("upsell_paid_check", {"key": key, "user_id": user_id, "identifier": identifier}, pipe=pipe)
+    await pipe.execute()
     return {"ok": True, "status": status}
 
 
+# ZREVRANGE + HMGET só dos campos exibidos, em um único round trip.
+# ARGV: prefixo da chave, depois os campos. Retorno plano: [access_key, [valores...], ...]
+_UPSELL_ROW_FIELDS = ("status", "amount", "user_id", "identifier", "created_at", "updated_at")
+_UPSELL_ROWS_LUA = """
+local keys = redis.call('ZREVRANGE', KEYS[1], 0, 199)
+local out = {}
+for _, k in ipairs(keys) do
+  out[#out + 1] = k
+  out[#out + 1] = redis.call('HMGET', ARGV[1] .. k, unpack(ARGV, 2))
+end
+return out
+"""
+_upsell_rows_script = aredis.register_script(_UPSELL_ROWS_LUA)
+
+_UPSELL_HEAD_BYTES = b"""<!doctype html>
+<html>
+  <head>
+    <meta charset="utf-8" />
+    <meta name="viewport" content="width=device-width, initial-scale=1" />
+    <title>Admin Upsell</title>
+    <style>
+      body { font-family: Arial, sans-serif; background:#0e0f14; color:#f3f5ff; margin:0; padding:16px; }
+      .cards { display:grid; grid-template-columns: repeat(auto-fit,minmax(180px,1fr)); gap:10px; margin-bottom:14px; }
+      .card { background:#161925; border-radius:10px; padding:12px; border:1px solid #23263a; }
+      .label { font-size:12px; color:#9ea6c7; }
+      .val { font-size:22px; font-weight:700; margin-top:4px; }
+      table { width:100%; border-collapse:collapse; background:#161925; border:1px solid #23263a; }
+      th, td { border-bottom:1px solid #23263a; padding:8px; text-align:left; font-size:12px; }
+      th { background:#1b2031; position:sticky; top:0; }
+      .events { margin-top:14px; background:#161925; border:1px solid #23263a; border-radius:10px; padding:12px; font-size:12px; max-height:260px; overflow:auto; }
+    </style>
+  </head>
+  <body>
+    <h1>Dashboard Upsell</h1>
+    <div class="cards">
+"""
+_UPSELL_MID_BYTES = b"""    </div>
+    <table>
+      <thead>
+        <tr>
+          <th>Access Key</th><th>User</th><th>Status</th><th>Valor</th><th>Identifier</th><th>Criado</th><th>Atualizado</th>
+        </tr>
+      </thead>
+      <tbody>"""
+_UPSELL_EMPTY_ROW_BYTES = b"<tr><td colspan='7'>Sem dados</td></tr>"
+_UPSELL_EVENTS_BYTES = b"""</tbody>
+    </table>
+    <div class="events">
+      <strong>Eventos recentes</strong><br/><br/>"""
+_UPSELL_TAIL_BYTES = b"""
+    </div>
+  </body>
+</html>"""
+_UPSELL_ROW_TMPL = (
+    "<tr><td>{access_key}</td><td>{user_id}</td><td>{status}</td><td>R$ {amount}</td>"
+    "<td>{identifier}</td><td>{created_at}</td><td>{updated_at}</td></tr>"
+)
+
+
 @app.get("/admin/upsell", response_class=HTMLResponse)
 async def admin_upsell_dashboard(token: Optional[str] = None, x_admin_token: Optional[str] = Header(default=None)):
     _upsell_auth(token or x_admin_token)
 
-    access_keys = redis.zrevrange(UPSELL_INDEX_ZSET, 0, 199)
+    # Linhas (script Lua) + eventos num único round trip.
+    pipe = aredis.pipeline(transaction=False)
+    await _upsell_rows_script(keys=[UPSELL_INDEX_ZSET], args=[UPSELL_KEY_PREFIX, *_UPSELL_ROW_FIELDS], client=pipe)
+    pipe.lrange(UPSELL_EVENTS_KEY, 0, 99)
+    flat, raw_events = await pipe.execute()
     rows = []
     total = 0
     pending = 0
@@ -722,10 +1057,11 @@ async def admin_upsell_dashboard(token: Optional[str] = None, x_admin_token: Opt
     failed = 0
     paid_amount = 0.0
 
-    for access_key in access_keys:
-        data = redis.hgetall(_upsell_key(access_key)) or {}
-        if not data:
+    for access_key, values in zip(flat[::2], flat[1::2]):
+        if not any(values):
+            # registro expirado que ainda está no índice
             continue
+        data = {k: v or "" for k, v in zip(_UPSELL_ROW_FIELDS, values)}
         total += 1
         status = (data.get("status") or "PENDING").upper()
         if status == "OK":
@@ -741,112 +1077,43 @@ async def admin_upsell_dashboard(token: Optional[str] = None, x_admin_token: Opt
         rows.append(
             {
                 "access_key": access_key,
-                "user_id": data.get("user_id", ""),
+                "user_id": data["user_id"],
                 "status": status,
-                "amount": data.get("amount", ""),
-                "identifier": data.get("identifier", ""),
-                "created_at": data.get("created_at", ""),
-                "updated_at": data.get("updated_at", ""),
+                "amount": data["amount"],
+                "identifier": data["identifier"],
+                "created_at": data["created_at"],
+                "updated_at": data["updated_at"],
             }
         )
 
-    event_lines = []
-    for raw in redis.lrange(UPSELL_EVENTS_KEY, 0, 99):
-        try:
-            item = json.loads(raw)
-            event_lines.append(html_escape(json.dumps(item, ensure_ascii=False)))
-        except Exception:
-            event_lines.append(html_escape(str(raw)))
-    events_html = "<br/>".join(event_lines) if event_lines else "Sem eventos"
-
-    rows_html = ""
-    for row in rows:
-        rows_html += (
-            "<tr>"
-            f"<td>{html_escape(str(row['access_key']))}</td>"
-            f"<td>{html_escape(str(row['user_id']))}</td>"
-            f"<td>{html_escape(str(row['status']))}</td>"
-            f"<td>R$ {html_escape(str(row['amount']))}</td>"
-            f"<td>{html_escape(str(row['identifier']))}</td>"
-            f"<td>{html_escape(str(row['created_at']))}</td>"
-            f"<td>{html_escape(str(row['updated_at']))}</td>"
-            "</tr>"
-        )
+    # Eventos já são gravados como JSON compacto: escapa o texto direto, sem loads/dumps.
+    events_html = "<br/>".join(_esc(raw) for raw in raw_events) if raw_events else "Sem eventos"
 
-    html = f"""<!doctype html>
-<html>
-  <head>
-    <meta charset="utf-8" />
-    <meta name="viewport" content="width=device-width, initial-scale=1" />
-    <title>Admin Upsell</title>
-    <style>
-      body {{ font-family: Arial, sans-serif; background:#0e0f14; color:#f3f5ff; margin:0; padding:16px; }}
-      .cards {{ display:grid; grid-template-columns: repeat(auto-fit,minmax(180px,1fr)); gap:10px; margin-bottom:14px; }}
-      .card {{ background:#161925; border-radius:10px; padding:12px; border:1px solid #23263a; }}
-      .label {{ font-size:12px; color:#9ea6c7; }}
-      .val {{ font-size:22px; font-weight:700; margin-top:4px; }}
-      table {{ width:100%; border-collapse:collapse; background:#161925; border:1px solid #23263a; }}
-      th, td {{ border-bottom:1px solid #23263a; padding:8px; text-align:left; font-size:12px; }}
-      th {{ background:#1b2031; position:sticky; top:0; }}
-      .events {{ margin-top:14px; background:#161925; border:1px solid #23263a; border-radius:10px; padding:12px; font-size:12px; max-height:260px; overflow:auto; }}
-    </style>
-  </head>
-  <body>
-    <h1>Dashboard Upsell</h1>
-    <div class="cards">
-      <div class="card"><div class="label">Total registros</div><div class="val">{total}</div></div>
-      <div class="card"><div class="label">Pendentes</div><div class="val">{pending}</div></div>
-      <div class="card"><div class="label">Pagos</div><div class="val">{paid}</div></div>
-      <div class="card"><div class="label">Falhos</div><div class="val">{failed}</div></div>
-      <div class="card"><div class="label">Receita upsell</div><div class="val">R$ {paid_amount:.2f}</div></div>
-    </div>
-    <table>
-      <thead>
-        <tr>
-          <th>Access Key</th><th>User</th><th>Status</th><th>Valor</th><th>Identifier</th><th>Criado</th><th>Atualizado</th>
-        </tr>
-      </thead>
-      <tbody>{rows_html or "<tr><td colspan='7'>Sem dados</td></tr>"}</tbody>
-    </table>
-    <div class="events">
-      <strong>Eventos recentes</strong><br/><br/>{events_html}
-    </div>
-  </body>
-</html>"""
-    return HTMLResponse(html)
+    cards_html = (
+        f'      <div class="card"><div class="label">Total registros</div><div class="val">{total}</div></div>\n'
+        f'      <div class="card"><div class="label">Pendentes</div><div class="val">{pending}</div></div>\n'
+        f'      <div class="card"><div class="label">Pagos</div><div class="val">{paid}</div></div>\n'
+        f'      <div class="card"><div class="label">Falhos</div><div class="val">{failed}</div></div>\n'
+        f'      <div class="card"><div class="label">Receita upsell</div><div class="val">R$ {paid_amount:.2f}</div></div>\n'
+    )
 
+    async def body():
+        yield _UPSELL_HEAD_BYTES
+        yield cards_html.encode("utf-8")
+        yield _UPSELL_MID_BYTES
+        for row in rows:
+            yield _UPSELL_ROW_TMPL.format_map({k: _esc(v) for k, v in row.items()}).encode("utf-8")
+        if not rows:
+            yield _UPSELL_EMPTY_ROW_BYTES
+        yield _UPSELL_EVENTS_BYTES
+        yield events_html.encode("utf-8")
+        yield _UPSELL_TAIL_BYTES
 
-@app.get("/admin/funnel", response_class=HTMLResponse)
-async def admin_funnel_dashboard(token: Optional[str] = None, x_admin_token: Optional[str] = Header(default=None)):
-    _upsell_auth(token or x_admin_token)
-    counters = get_funnel_counters()
-    day = get_day_counters_utc()
-    created = int(counters.get("pix_created", "0") or "0")
-    reused = int(counters.get("pix_reused", "0") or "0")
-    viewed = int(counters.get("pix_viewed", "0") or "0")
-    verify_clicked = int(counters.get("verify_clicked", "0") or "0")
-    paid = int(counters.get("payment_confirmed", "0") or "0")
+    return StreamingResponse(body(), media_type="text/html; charset=utf-8")
 
-    def pct(a: int, b: int) -> str:
-        if b <= 0:
-            return "0.0%"
-        return f"{(100.0 * a / b):.1f}%"
 
-    rows_html = ""
-    for k, v in sorted(counters.items()):
-        rows_html += f"<tr><td>{html_escape(str(k))}</td><td>{html_escape(str(v))}</td></tr>"
-    today_html = ""
-    for k, v in sorted(day.items()):
-        today_html += f"<tr><td>{html_escape(str(k))}</td><td>{html_escape(str(v))}</td></tr>"
-
-    events = redis.lrange("tg:funnel:events", 0, 99)
-    events_html = ""
-    for raw in events:
-        events_html += f"{html_escape(raw)}<br/>"
-    if not events_html:
-        events_html = "Sem eventos"
-
-    html = f"""<!doctype html>
+# Template da página montado uma vez no import; por request só entram os valores.
+_FUNNEL_PAGE_TMPL = """<!doctype html>
 <html>
   <head>
     <meta charset="utf-8" />
@@ -872,24 +1139,84 @@ async def admin_funnel_dashboard(token: Optional[str] = None, x_admin_token: Opt
       <div class="card"><div class="label">Pix vistos</div><div class="val">{viewed}</div></div>
       <div class="card"><div class="label">Cliques em verificar</div><div class="val">{verify_clicked}</div></div>
       <div class="card"><div class="label">Pagos</div><div class="val">{paid}</div></div>
-      <div class="card"><div class="label">Conversão pagamento</div><div class="val">{pct(paid, created)}</div></div>
-      <div class="card"><div class="label">Conversão pós visualização</div><div class="val">{pct(paid, viewed)}</div></div>
-      <div class="card"><div class="label">Verify -> Pago</div><div class="val">{pct(paid, verify_clicked)}</div></div>
+      <div class="card"><div class="label">Conversão pagamento</div><div class="val">{conv_created}</div></div>
+      <div class="card"><div class="label">Conversão pós visualização</div><div class="val">{conv_viewed}</div></div>
+      <div class="card"><div class="label">Verify -> Pago</div><div class="val">{conv_verify}</div></div>
     </div>
     <div class="grid">
       <table>
         <thead><tr><th>Contador global</th><th>Valor</th></tr></thead>
-        <tbody>{rows_html or "<tr><td colspan='2'>Sem dados</td></tr>"}</tbody>
+        <tbody>{rows_html}</tbody>
       </table>
       <table>
         <thead><tr><th>Contador de hoje (UTC)</th><th>Valor</th></tr></thead>
-        <tbody>{today_html or "<tr><td colspan='2'>Sem dados</td></tr>"}</tbody>
+        <tbody>{today_html}</tbody>
       </table>
     </div>
     <div class="events"><strong>Eventos recentes</strong><br/><br/>{events_html}</div>
   </body>
 </html>"""
-    return HTMLResponse(html)
+_FUNNEL_EMPTY_ROW = "<tr><td colspan='2'>Sem dados</td></tr>"
+# Template já parseado (literal, campo) no import: render é só um join, sem re-parse do .format.
+_FUNNEL_PAGE_PARTS = tuple(
+    (literal, field) for literal, field, _, _ in string.Formatter().parse(_minify_html(_FUNNEL_PAGE_TMPL))
+)
+
+
+def _render_funnel_page(values: dict) -> str:
+    return "".join(literal + (str(values[field]) if field else "") for literal, field in _FUNNEL_PAGE_PARTS)
+
+# Página do funil renderizada fica em memória por alguns segundos (absorve refresh em rajada).
+FUNNEL_PAGE_CACHE_TTL_SECONDS = 2.0
+_FUNNEL_CACHE: Optional[tuple[float, bytes]] = None
+
+
+@app.get("/admin/funnel", response_class=HTMLResponse)
+async def admin_funnel_dashboard(token: Optional[str] = None, x_admin_token: Optional[str] = Header(default=None)):
+    global _FUNNEL_CACHE
+    _upsell_auth(token or x_admin_token)
+    now = time.monotonic()
+    if _FUNNEL_CACHE and now - _FUNNEL_CACHE[0] < FUNNEL_PAGE_CACHE_TTL_SECONDS:
+        return Response(content=_FUNNEL_CACHE[1], media_type="text/html; charset=utf-8")
+
+    counters, day, events = await aget_funnel_snapshot(events_limit=100)
+    created = int(counters.get("pix_created", "0") or "0")
+    reused = int(counters.get("pix_reused", "0") or "0")
+    viewed = int(counters.get("pix_viewed", "0") or "0")
+    verify_clicked = int(counters.get("verify_clicked", "0") or "0")
+    paid = int(counters.get("payment_confirmed", "0") or "0")
+
+    def pct(a: int, b: int) -> str:
+        if b <= 0:
+            return "0.0%"
+        return f"{(100.0 * a / b):.1f}%"
+
+    rows_html = "".join(f"<tr><td>{_esc(k)}</td><td>{_esc(v)}</td></tr>" for k, v in sorted(counters.items()))
+    today_html = "".join(f"<tr><td>{_esc(k)}</td><td>{_esc(v)}</td></tr>" for k, v in sorted(day.items()))
+    events_html = "".join(f"{_esc(raw)}<br/>" for raw in events) or "Sem eventos"
+
+    html = _render_funnel_page(
+        {
+            "created": created,
+            "reused": reused,
+            "viewed": viewed,
+            "verify_clicked": verify_clicked,
+            "paid": paid,
+            "conv_created": pct(paid, created),
+            "conv_viewed": pct(paid, viewed),
+            "conv_verify": pct(paid, verify_clicked),
+            "rows_html": rows_html or _FUNNEL_EMPTY_ROW,
+            "today_html": today_html or _FUNNEL_EMPTY_ROW,
+            "events_html": events_html,
+        }
+    )
+    # Entrega bytes prontos: a Response não precisa reconverter str -> bytes.
+    body = html.encode("utf-8")
+    _FUNNEL_CACHE = (now, body)
+    return Response(content=body, media_type="text/html; charset=utf-8")
+
+
+FUNNEL_RESET_BATCH = 500
 
 
 @app.post("/admin/funnel/reset")
@@ -903,6 +1230,7 @@ async def admin_funnel_reset(
     Reseta métricas do funil.
     Segurança: exige token + confirm=RESET.
     """
+    global _FUNNEL_CACHE
     _upsell_auth(token or x_admin_token)
     if (confirm or "").upper() != "RESET":
         return {
@@ -911,29 +1239,27 @@ async def admin_funnel_reset(
             "hint": "Use confirm=RESET",
         }
 
+    _FUNNEL_CACHE = None
     deleted = []
+    day_keys = []
     try:
-        if redis.exists(FUNNEL_EVENTS_KEY):
-            redis.delete(FUNNEL_EVENTS_KEY)
+        day_keys = list(await aredis.smembers(FUNNEL_DAY_INDEX_KEY))
+        # UNLINK em chave inexistente é no-op: dispensa o EXISTS e vai tudo num round-trip.
+        # UNLINK libera a memória em background e os dias vão em lotes, sem travar o Redis.
+        pipe = aredis.pipeline(transaction=False)
+        pipe.unlink(FUNNEL_EVENTS_KEY)
+        pipe.unlink(FUNNEL_COUNTERS_KEY)
+        for i in range(0, len(day_keys), FUNNEL_RESET_BATCH):
+            pipe.unlink(*day_keys[i:i + FUNNEL_RESET_BATCH])
+        pipe.unlink(FUNNEL_DAY_INDEX_KEY)
+        events_deleted, counters_deleted, *_ = await pipe.execute()
+        if events_deleted:
             deleted.append(FUNNEL_EVENTS_KEY)
-    except Exception:
-        pass
-    try:
-        if redis.exists(FUNNEL_COUNTERS_KEY):
-            redis.delete(FUNNEL_COUNTERS_KEY)
+        if counters_deleted:
             deleted.append(FUNNEL_COUNTERS_KEY)
     except Exception:
         pass
 
-    day_keys = []
-    try:
-        for k in redis.scan_iter(f"{FUNNEL_DAY_PREFIX}*"):
-            day_keys.append(k)
-        if day_keys:
-            redis.delete(*day_keys)
-    except Exception:
-        pass
-
     return {
         "ok": True,
         "deleted_keys": deleted,
@@ -946,16 +1272,33 @@ async def admin_funnel_reset(
 async def head_p():
     return {"ok": True}
 
+async def _enqueue_update(raw: bytes) -> None:
+    # Wrapper async: os comandos do redis.asyncio não são "async def", e o
+    # BackgroundTasks os rodaria numa thread sem nunca aguardar a coroutine.
+    # O Telegram já recebeu 200 e não reenvia: uma nova tentativa e, se falhar, log.
+    for attempt in (1, 2):
+        try:
+            await aredis.rpush(QUEUE_KEY, raw)
+            return
+        except Exception as e:
+            if attempt == 2:
+                log("[WEBHOOK] enqueue erro (update perdido)", type(e).__name__, str(e), raw[:200])
+                return
+            await asyncio.sleep(0.2)
+
+
 @app.post("/telegram/webhook")
 async def telegram_webhook(
     request: Request,
+    background_tasks: BackgroundTasks,
     x_telegram_bot_api_secret_token: Optional[str] = Header(default=None),
 ):
     if WEBHOOK_SECRET and x_telegram_bot_api_secret_token != WEBHOOK_SECRET:
         return {"ok": False}
 
-    data = await request.json()
-    redis.rpush(QUEUE_KEY, json.dumps(data))
+    # Enfileira o corpo cru depois de responder: o Telegram recebe o 200 sem esperar
+    # o RPUSH, e o parse/validação do JSON fica só no worker.
+    background_tasks.add_task(_enqueue_update, await request.body())
     return {"ok": True}
 
 
@@ -967,51 +1310,128 @@ def _verify_stripe_signature(raw_body: bytes, stripe_signature: str) -> bool:
         return True
     if not stripe_signature:
         return False
-    parts = {}
+    # Varredura única do header, sem dict intermediário. Pode haver mais de um v1
+    # (rotação de secret na Stripe): basta um bater.
+    timestamp = ""
+    sigs_v1 = []
     for item in stripe_signature.split(","):
-        if "=" in item:
-            k, v = item.split("=", 1)
-            parts[k.strip()] = v.strip()
-    timestamp = parts.get("t")
-    sig_v1 = parts.get("v1")
-    if not timestamp or not sig_v1:
+        item = item.strip()
+        if item.startswith("t="):
+            timestamp = item[2:]
+        elif item.startswith("v1="):
+            sigs_v1.append(item[3:].encode("utf-8"))
+    if not timestamp or not sigs_v1:
         return False
-    signed_payload = f"{timestamp}.{raw_body.decode('utf-8')}".encode("utf-8")
-    expected = hmac.new(
-        STRIPE_WEBHOOK_SECRET.encode("utf-8"),
-        signed_payload,
-        hashlib.sha256,
-    ).hexdigest()
-    return hmac.compare_digest(expected, sig_v1)
+    # Assina "{t}.{body}" alimentando o HMAC com os bytes originais (sem decode/encode do body).
+    mac = hmac.new(STRIPE_WEBHOOK_SECRET.encode("utf-8"), digestmod=hashlib.sha256)
+    mac.update(timestamp.encode("utf-8"))
+    mac.update(b".")
+    mac.update(raw_body)
+    expected = mac.hexdigest().encode("ascii")
+    return any(hmac.compare_digest(expected, sig) for sig in sigs_v1)
+
+
+async def _finalize_stripe_paid(
+    user_id: int,
+    chat_id_str: Optional[str],
+    obj: dict,
+    metadata: dict,
+    identifier: str,
+    session_id: str,
+    stored_amount: Optional[str],
+) -> None:
+    """Pós-pagamento Stripe (funil, entrega do acesso e tracking), executado em background."""
+    try:
+        pipe = aredis.pipeline(transaction=False)
+        record_funnel_event("payment_confirmed", user_id=user_id, pipe=pipe)
+        await pipe.execute()
+    except Exception:
+        pass
+
+    # Deliver access key to user immediately via Telegram
+    try:
+        if chat_id_str:
+            await deliver_access_if_needed(_get_bot(), user_id, int(chat_id_str))
+        else:
+            log("[STRIPE CALLBACK] no chat_id for delivery", {"user_id": user_id})
+    except Exception as e:
+        log("[STRIPE CALLBACK] DELIVERY ERRO", type(e).__name__, str(e))
+
+    # Tracking paid (UTMify + Facebook CAPI)
+    try:
+        utms = await aget_utms(user_id)
+        # amount_total (checkout session) or amount/amount_received (payment_intent) — in cents
+        amount_cents_raw = int(
+            obj.get("amount_total")
+            or obj.get("amount_received")
+            or obj.get("amount")
+            or 0
+        )
+        amount = (amount_cents_raw / 100.0) if amount_cents_raw > 0 else float(stored_amount or "0")
+        order_id = str(identifier or session_id or "")
+        # customer_details (checkout session) or billing_details from charge
+        cust = obj.get("customer_details") or {}
+        if not cust.get("email"):
+            # payment_intent events don't have customer_details; use charge billing_details
+            charge_data = (obj.get("charges") or {}).get("data") or []
+            if charge_data:
+                cust = charge_data[0].get("billing_details") or {}
+        customer_payload = {
+            "name": str(cust.get("name") or DEFAULT_CLIENT_NAME or ""),
+            "email": str(cust.get("email") or DEFAULT_CLIENT_EMAIL or ""),
+            "phone": str(cust.get("phone") or DEFAULT_CLIENT_PHONE or ""),
+            "document": str(metadata.get("document") or DEFAULT_CLIENT_DOCUMENT or ""),
+        }
+        await send_paid_tracking(
+            order_id=order_id,
+            amount=amount,
+            currency="GBP",
+            customer=customer_payload,
+            utms=utms,
+            log_tag="[STRIPE CALLBACK]",
+            platform="Telegram-UK",
+            payment_method="credit_card",
+        )
+    except Exception as e:
+        log("[STRIPE CALLBACK] TRACKING ERRO", type(e).__name__, str(e))
 
 
 @app.post("/stripe/webhook")
-async def stripe_webhook(request: Request, stripe_signature: Optional[str] = Header(default=None, alias="Stripe-Signature")):
+async def stripe_webhook(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    stripe_signature: Optional[str] = Header(default=None, alias="Stripe-Signature"),
+):
+    idem = ""
     try:
         raw_body = await request.body()
         if not _verify_stripe_signature(raw_body, stripe_signature or ""):
             log("[STRIPE CALLBACK] assinatura inválida")
             return {"ok": False}
 
-        event = json.loads(raw_body.decode("utf-8"))
-        event_type = str(event.get("type") or "")
+        event = orjson.loads(raw_body)
+        stripe_event_id = _first_str(event, "id")
+        claim = f"stripe:{stripe_event_id}" if stripe_event_id else ""
+        if not await _first_delivery(claim):
+            log("[STRIPE CALLBACK] evento repetido ignorado", {"event_id": stripe_event_id})
+            return {"ok": True}
+        # A partir daqui o marcador é nosso: saída sem gravar status libera (ver except).
+        idem = claim
+        event_type = _first_str(event, "type")
         obj = (event.get("data") or {}).get("object") or {}
-        session_id = str(obj.get("id") or "")
-        payment_status = str(obj.get("payment_status") or obj.get("status") or "")
+        session_id = _first_str(obj, "id")
+        payment_status = _first_str(obj, "payment_status", "status")
 
         # mapeia user_id por prioridade
         metadata = obj.get("metadata") or {}
-        user_id_str = str(
-            obj.get("client_reference_id")
-            or metadata.get("user_id")
-            or ""
-        ).strip()
-        event_id = str(metadata.get("event_id") or "")
-
-        if not user_id_str and session_id:
-            user_id_str = get_redis().hget("tg:pix:identifier_map", session_id) or ""
-        if not user_id_str and event_id:
-            user_id_str = get_redis().hget("tg:pix:identifier_map", event_id) or ""
+        user_id_str = (_first_str(obj, "client_reference_id") or _first_str(metadata, "user_id")).strip()
+        event_id = _first_str(metadata, "event_id")
+
+        # session_id e event_id num único HMGET (prioridade na ordem dos campos)
+        map_fields = [f for f in (session_id, event_id) if f]
+        if not user_id_str and map_fields:
+            vals = await aredis.hmget("tg:pix:identifier_map", map_fields)
+            user_id_str = next((v for v in vals if v), "")
 
         # ── Fallback for payment_intent.* events ──
         # payment_intent objects don't have client_reference_id and may have
@@ -1020,8 +1440,6 @@ async def stripe_webhook(request: Request, stripe_signature: Optional[str] = Hea
         # checkout session by payment_intent ID.
         if not user_id_str and event_type.startswith("payment_intent.") and session_id.startswith("pi_"):
             try:
-                import httpx
-                from .config import STRIPE_SECRET_KEY
                 async with httpx.AsyncClient(timeout=10.0, headers={"Authorization": f"Bearer {STRIPE_SECRET_KEY}"}) as hc:
                     res = await hc.get(
                         "https://api.stripe.com/v1/checkout/sessions",
@@ -1032,19 +1450,17 @@ async def stripe_webhook(request: Request, stripe_signature: Optional[str] = Hea
                         if sessions:
                             cs = sessions[0]
                             cs_meta = cs.get("metadata") or {}
-                            user_id_str = str(
-                                cs.get("client_reference_id")
-                                or cs_meta.get("user_id")
-                                or ""
+                            user_id_str = (
+                                _first_str(cs, "client_reference_id") or _first_str(cs_meta, "user_id")
                             ).strip()
                             if not event_id:
-                                event_id = str(cs_meta.get("event_id") or "")
+                                event_id = _first_str(cs_meta, "event_id")
                             # Merge the session metadata so tracking works
                             if not metadata.get("user_id") and cs_meta:
                                 metadata = cs_meta
                             # Cache the PI -> user mapping for future events
                             if user_id_str and session_id:
-                                get_redis().hset("tg:pix:identifier_map", session_id, user_id_str)
+                                await aredis.hset("tg:pix:identifier_map", session_id, user_id_str)
                             log("[STRIPE CALLBACK] fallback API resolved", {
                                 "pi": session_id,
                                 "user_id": user_id_str,
@@ -1055,6 +1471,8 @@ async def stripe_webhook(request: Request, stripe_signature: Optional[str] = Hea
 
         if not user_id_str:
             log("[STRIPE CALLBACK] user_id ausente", {"session_id": session_id, "event_type": event_type})
+            # fallback da API pode ter falhado ou o mapa ainda não existir: reentrega tenta de novo
+            await _forget_delivery(idem)
             return {"ok": True}
 
         user_id = int(user_id_str)
@@ -1073,157 +1491,150 @@ async def stripe_webhook(request: Request, stripe_signature: Optional[str] = Hea
         ):
             status = "FAILED"
 
-        r = get_redis()
+        r = aredis
         pix_key = f"tg:pix:{user_id}"
-        r.hset(
+
+        # Leituras usadas mais abaixo, em um único round trip.
+        read_pipe = r.pipeline(transaction=False)
+        read_pipe.hmget(pix_key, "identifier", "amount")
+        read_pipe.hget(f"tg:user:{user_id}", "chat_id")
+        (stored_identifier, stored_amount), chat_id_str = await read_pipe.execute()
+        identifier = event_id or stored_identifier or ""
+
+        # Escritas do callback (status, mapas de ids, dedup, fila pendente) em um único round trip.
+        pipe = r.pipeline(transaction=False)
+        pipe.hset(
             pix_key,
             mapping={
                 "status": status,
                 "transaction_id": session_id,
                 "payment_code": session_id,
                 "stripe_session_id": session_id,
-                "identifier": event_id or (r.hget(pix_key, "identifier") or ""),
+                "identifier": identifier,
                 "gateway": "stripe",
             },
         )
-
         # map session/event ids for future callbacks
-        try:
-            if session_id:
-                r.hset("tg:pix:identifier_map", session_id, str(user_id))
-            if event_id:
-                r.hset("tg:pix:identifier_map", event_id, str(user_id))
-        except Exception:
-            pass
-
-        from .pix_payment import mark_payment_confirmed
-        from .campaign import mark_paid
-        from .tracking import get_utms, send_facebook_event, send_to_utmify_order
-        from .config import (
-            BOT_TOKEN,
-            DEFAULT_CLIENT_DOCUMENT,
-            DEFAULT_CLIENT_EMAIL,
-            DEFAULT_CLIENT_NAME,
-            DEFAULT_CLIENT_PHONE,
-        )
-
+        if session_id:
+            pipe.hset("tg:pix:identifier_map", session_id, str(user_id))
+        if event_id:
+            pipe.hset("tg:pix:identifier_map", event_id, str(user_id))
+        dedup_idx = None
         if status == "OK":
             # ── Dedup: prevent double tracking if both checkout.session.completed
             # AND payment_intent.succeeded arrive for the same user ──
-            dedup_key = f"tg:stripe:paid_dedup:{user_id}"
-            already_processed = False
-            try:
-                already_processed = not r.set(dedup_key, "1", nx=True, ex=3600)
-            except Exception:
-                pass
+            dedup_idx = len(pipe)
+            pipe.set(f"tg:stripe:paid_dedup:{user_id}", "1", nx=True, ex=3600)
+        if status not in ("PENDING", "WAITING_PAYMENT"):
+            pipe.zrem(PIX_PENDING_ZSET, str(user_id))
+        # Evento do funil vai no mesmo round trip das escritas de status.
+        if status in ("PENDING", "WAITING_PAYMENT"):
+            record_funnel_event("payment_pending", user_id=user_id, pipe=pipe)
+        elif status != "OK":
+            record_funnel_event("payment_failed", user_id=user_id, gateway_status=status, pipe=pipe)
+        if status == "OK":
+            mark_payment_confirmed(user_id, pipe=pipe)
+            mark_paid(user_id, pipe=pipe)
+        results = await pipe.execute()
 
-            mark_payment_confirmed(user_id)
-            mark_paid(user_id)
-            try:
-                redis.srem(PIX_PENDING_SET, str(user_id))
-            except Exception:
-                pass
+        if status == "OK":
+            already_processed = not results[dedup_idx]
 
             if already_processed:
                 log("[STRIPE CALLBACK] dedup skip (already processed)", {"user_id": user_id, "event_type": event_type})
                 return {"ok": True}
 
-            record_funnel_event("payment_confirmed", user_id=user_id)
-
-            # Deliver access key to user immediately via Telegram
-            try:
-                from .access_delivery import deliver_access_if_needed
-                from aiogram import Bot
-                _bot = Bot(BOT_TOKEN)
-                chat_id_str = r.hget(f"tg:user:{user_id}", "chat_id")
-                if chat_id_str:
-                    await deliver_access_if_needed(_bot, user_id, int(chat_id_str))
-                else:
-                    log("[STRIPE CALLBACK] no chat_id for delivery", {"user_id": user_id})
-                await _bot.session.close()
-            except Exception as e:
-                log("[STRIPE CALLBACK] DELIVERY ERRO", type(e).__name__, str(e))
-
-            # Tracking paid (UTMify + Facebook CAPI)
-            try:
-                utms = get_utms(user_id)
-                # amount_total (checkout session) or amount/amount_received (payment_intent) — in cents
-                amount_cents_raw = int(
-                    obj.get("amount_total")
-                    or obj.get("amount_received")
-                    or obj.get("amount")
-                    or 0
-                )
-                amount = (amount_cents_raw / 100.0) if amount_cents_raw > 0 else float(r.hget(pix_key, "amount") or "0")
-                order_id = str(r.hget(pix_key, "identifier") or event_id or session_id or "")
-                # customer_details (checkout session) or billing_details from charge
-                cust = obj.get("customer_details") or {}
-                if not cust.get("email"):
-                    # payment_intent events don't have customer_details; use charge billing_details
-                    charge_data = (obj.get("charges") or {}).get("data") or []
-                    if charge_data:
-                        cust = charge_data[0].get("billing_details") or {}
-                customer_payload = {
-                    "name": str(cust.get("name") or DEFAULT_CLIENT_NAME or ""),
-                    "email": str(cust.get("email") or DEFAULT_CLIENT_EMAIL or ""),
-                    "phone": str(cust.get("phone") or DEFAULT_CLIENT_PHONE or ""),
-                    "document": str(metadata.get("document") or DEFAULT_CLIENT_DOCUMENT or ""),
-                }
-                await send_to_utmify_order(
-                    order_id=order_id,
-                    status="paid",
-                    amount=amount,
-                    customer=customer_payload,
-                    utms=utms,
-                    platform="Telegram-UK",
-                    payment_method="credit_card",
-                )
-                await send_facebook_event(
-                    event_name="Purchase",
-                    event_id=order_id,
-                    amount=amount,
-                    currency="GBP",
-                    customer=customer_payload,
-                    utms=utms,
-                )
-            except Exception as e:
-                log("[STRIPE CALLBACK] TRACKING ERRO", type(e).__name__, str(e))
-        else:
-            if status in ("PENDING", "WAITING_PAYMENT"):
-                record_funnel_event("payment_pending", user_id=user_id)
-            else:
-                try:
-                    redis.srem(PIX_PENDING_SET, str(user_id))
-                except Exception:
-                    pass
-                record_funnel_event("payment_failed", user_id=user_id, gateway_status=status)
+            # Entrega + tracking rodam depois do 200 (gateway não espera Telegram/UTMify/CAPI).
+            background_tasks.add_task(
+                _finalize_stripe_paid,
+                user_id,
+                chat_id_str,
+                obj,
+                metadata,
+                identifier,
+                session_id,
+                stored_amount,
+            )
 
         return {"ok": True}
     except Exception as e:
         log("[STRIPE CALLBACK] ERRO", type(e).__name__, str(e))
+        await _forget_delivery(idem)
         return {"ok": True}
 
 
+async def _finalize_mangofy_paid(
+    user_id: int,
+    order_id: str,
+    stored_amount: Optional[str],
+    data: dict,
+    metadata: dict,
+    customer: dict,
+) -> None:
+    """Tracking pós-pagamento Mangofy (UTMify + Facebook CAPI), executado em background."""
+    # Tracking: UTMify + Facebook CAPI
+    try:
+        utms = await aget_utms(user_id)
+        # Prioriza utms vindos do webhook
+        webhook_utms = metadata.get("utms")
+        if webhook_utms and isinstance(webhook_utms, dict):
+            utms = webhook_utms
+
+        # Mangofy envia amount em centavos — converter para reais
+        amount = float(stored_amount or "0")
+        if amount == 0:
+            raw_cents = data.get("payment_amount") or data.get("sale_amount") or 0
+            if raw_cents and int(raw_cents) > 100:
+                amount = int(raw_cents) / 100.0
+
+        customer_payload = {
+            "name": customer.get("name") or DEFAULT_CLIENT_NAME or "",
+            "email": customer.get("email") or DEFAULT_CLIENT_EMAIL or "",
+            "phone": str(customer.get("phone") or DEFAULT_CLIENT_PHONE or ""),
+            "document": str(customer.get("document") or DEFAULT_CLIENT_DOCUMENT or ""),
+        }
+        await send_paid_tracking(
+            order_id=order_id,
+            amount=amount,
+            currency="BRL",
+            customer=customer_payload,
+            utms=utms,
+            log_tag="[MANGOFY CALLBACK]",
+        )
+    except Exception as e:
+        log("[MANGOFY CALLBACK] TRACKING ERRO", type(e).__name__, str(e))
+
+
 @app.post("/mangofy/callback")
 @app.get("/mangofy/callback")
 @app.head("/mangofy/callback")
-async def mangofy_callback(request: Request):
+async def mangofy_callback(request: Request, background_tasks: BackgroundTasks):
     """
     Webhook da Mangofy para notificar alterações de status de pagamento.
     Formato: {"payment_code": "...", "external_code": "...", "payment_status": "approved|pending|refunded|error", ...}
     """
+    idem = ""
     try:
         if request.method != "POST":
             return {"received": True}
 
-        data = await request.json()
-        log("[MANGOFY CALLBACK] RECEBIDO", json.dumps(data)[:2000])
+        data = orjson.loads(await request.body())
+        log("[MANGOFY CALLBACK] RECEBIDO", orjson.dumps(data)[:2000].decode("utf-8", errors="ignore"))
 
         payment_code = data.get("payment_code") or ""
         external_code = data.get("external_code") or ""
         status_raw = data.get("payment_status") or ""
         customer = data.get("customer") or {}
 
+        # Mesmo pagamento + mesmo status = reentrega; mudança de status passa.
+        payment_ref = payment_code or external_code
+        claim = f"mangofy:{payment_ref}:{status_raw}" if payment_ref else ""
+        if not await _first_delivery(claim):
+            log("[MANGOFY CALLBACK] evento repetido ignorado", {"payment_code": payment_code, "status": status_raw})
+            return {"received": True}
+        # A partir daqui o marcador é nosso: saída sem gravar status libera (ver except).
+        idem = claim
+
         # metadata vem do extra.metadata da criação
         metadata = data.get("metadata") or {}
         # Mangofy às vezes aninha: metadata.metadata
@@ -1237,17 +1648,12 @@ async def mangofy_callback(request: Request):
         # Encontra user_id: metadata > identifier_map
         user_id_str = metadata.get("user_id")
 
-        # fallback: busca por external_code no mapa identifier -> user_id
-        if not user_id_str and external_code:
+        # fallback: busca external_code e payment_code no mapa identifier -> user_id (um único HMGET)
+        map_fields = [f for f in (external_code, payment_code) if f]
+        if not user_id_str and map_fields:
             try:
-                user_id_str = get_redis().hget("tg:pix:identifier_map", external_code)
-            except Exception:
-                user_id_str = None
-
-        # fallback: busca por payment_code no mapa
-        if not user_id_str and payment_code:
-            try:
-                user_id_str = get_redis().hget("tg:pix:identifier_map", payment_code)
+                vals = await aredis.hmget("tg:pix:identifier_map", map_fields)
+                user_id_str = next((v for v in vals if v), None)
             except Exception:
                 user_id_str = None
 
@@ -1256,125 +1662,97 @@ async def mangofy_callback(request: Request):
                 "payment_code": payment_code,
                 "external_code": external_code,
             })
+            await _forget_delivery(idem)
             return {"received": True}
 
         user_id = int(user_id_str)
 
-        # Importa aqui para evitar circular import
-        from .pix_payment import mark_payment_confirmed
-        from .campaign import mark_paid
-        from .tracking import get_utms, send_facebook_event, send_to_utmify_order
-        from .config import (
-            DEFAULT_CLIENT_DOCUMENT,
-            DEFAULT_CLIENT_EMAIL,
-            DEFAULT_CLIENT_NAME,
-            DEFAULT_CLIENT_PHONE,
-        )
-
-        r = get_redis()
+        r = aredis
         pix_key = f"tg:pix:{user_id}"
 
         # Normaliza status (Mangofy: approved, pending, refunded, error)
         status = _map_gateway_status(str(status_raw))
 
-        # Atualiza status no Redis
-        r.hset(pix_key, "status", status)
-        if external_code:
-            r.hset(pix_key, "identifier", external_code)
-        if payment_code:
-            r.hset(pix_key, mapping={"transaction_id": payment_code, "payment_code": payment_code})
-
+        # Leituras (estado do pix + access_key de upsell) em um único round trip.
         # Se for uma cobrança de upsell, mantém status sincronizado por access_key.
         identifier = external_code or payment_code
-        if identifier:
-            try:
-                access_key = r.hget(UPSELL_IDENTIFIER_MAP_KEY, identifier)
-                if access_key:
-                    up_key = _upsell_key(access_key)
-                    mapping = {
-                        "status": status,
-                        "updated_at": str(int(datetime.utcnow().timestamp())),
-                        "transaction_id": str(payment_code or ""),
-                    }
-                    if status == "OK":
-                        mapping["paid_at"] = str(int(datetime.utcnow().timestamp()))
-                    r.hset(up_key, mapping=mapping)
-                    _upsell_event(
-                        "upsell_callback_status",
-                        {
-                            "key": access_key,
-                            "user_id": user_id,
-                            "identifier": identifier,
-                            "status": status,
-                        },
-                    )
-            except Exception:
-                pass
+        stored_identifier = stored_amount = access_key = None
+        try:
+            read_pipe = r.pipeline(transaction=False)
+            read_pipe.hmget(pix_key, "identifier", "amount")
+            if identifier:
+                read_pipe.hget(UPSELL_IDENTIFIER_MAP_KEY, identifier)
+            read_results = await read_pipe.execute()
+            stored_identifier, stored_amount = read_results[0]
+            if identifier:
+                access_key = read_results[1]
+        except Exception:
+            pass
+
+        # Atualiza status no Redis (pix, upsell e fila pendente) em um único round trip.
+        pix_update = {"status": status}
+        if external_code:
+            pix_update["identifier"] = external_code
+        if payment_code:
+            pix_update["transaction_id"] = payment_code
+            pix_update["payment_code"] = payment_code
+        pipe = r.pipeline(transaction=False)
+        pipe.hset(pix_key, mapping=pix_update)
+        if access_key:
+            now_ts = str(int(time.time()))
+            mapping = {
+                "status": status,
+                "updated_at": now_ts,
+                "transaction_id": str(payment_code or ""),
+            }
+            if status == "OK":
+                mapping["paid_at"] = now_ts
+            pipe.hset(_upsell_key(access_key), mapping=mapping)
+        if status != "PENDING":
+            pipe.zrem(PIX_PENDING_ZSET, str(user_id))
+        # Evento do upsell e do funil no mesmo round trip das escritas de status.
+        if access_key:
+            await _upsell_event(
+                "upsell_callback_status",
+                {
+                    "key": access_key,
+                    "user_id": user_id,
+                    "identifier": identifier,
+                    "status": status,
+                },
+                pipe=pipe,
+            )
+        if status == "OK":
+            record_funnel_event("payment_confirmed", user_id=user_id, pipe=pipe)
+            mark_payment_confirmed(user_id, pipe=pipe)
+            mark_paid(user_id, pipe=pipe)
+        elif status == "PENDING":
+            record_funnel_event("payment_pending", user_id=user_id, pipe=pipe)
+        else:
+            record_funnel_event("payment_failed", user_id=user_id, gateway_status=status, pipe=pipe)
+        await pipe.execute()
 
         if status == "OK":
-            mark_payment_confirmed(user_id)
-            mark_paid(user_id)
-            try:
-                redis.srem(PIX_PENDING_SET, str(user_id))
-            except Exception:
-                pass
             log("[MANGOFY CALLBACK] STATUS OK", {"user_id": user_id, "payment_code": payment_code})
-            record_funnel_event("payment_confirmed", user_id=user_id)
 
-            # Tracking: UTMify + Facebook CAPI
-            try:
-                utms = get_utms(user_id)
-                # Prioriza utms vindos do webhook
-                webhook_utms = metadata.get("utms")
-                if webhook_utms and isinstance(webhook_utms, dict):
-                    utms = webhook_utms
-
-                # Mangofy envia amount em centavos — converter para reais
-                amount_str = r.hget(pix_key, "amount") or "0"
-                amount = float(amount_str)
-                if amount == 0:
-                    raw_cents = data.get("payment_amount") or data.get("sale_amount") or 0
-                    if raw_cents and int(raw_cents) > 100:
-                        amount = int(raw_cents) / 100.0
-
-                order_id = r.hget(pix_key, "identifier") or external_code or payment_code or ""
-                customer_payload = {
-                    "name": customer.get("name") or DEFAULT_CLIENT_NAME or "",
-                    "email": customer.get("email") or DEFAULT_CLIENT_EMAIL or "",
-                    "phone": str(customer.get("phone") or DEFAULT_CLIENT_PHONE or ""),
-                    "document": str(customer.get("document") or DEFAULT_CLIENT_DOCUMENT or ""),
-                }
-                await send_to_utmify_order(
-                    order_id=order_id,
-                    status="paid",
-                    amount=amount,
-                    customer=customer_payload,
-                    utms=utms,
-                )
-                await send_facebook_event(
-                    event_name="Purchase",
-                    event_id=order_id,
-                    amount=amount,
-                    currency="BRL",
-                    customer=customer_payload,
-                    utms=utms,
-                )
-            except Exception as e:
-                log("[MANGOFY CALLBACK] TRACKING ERRO", type(e).__name__, str(e))
+            # Tracking roda depois do 200 (gateway não espera UTMify/CAPI).
+            background_tasks.add_task(
+                _finalize_mangofy_paid,
+                user_id,
+                # o HSET acima grava external_code como identifier quando presente
+                external_code or stored_identifier or payment_code or "",
+                stored_amount,
+                data,
+                metadata,
+                customer,
+            )
         else:
             log("[MANGOFY CALLBACK] STATUS", status, {"user_id": user_id, "payment_code": payment_code})
-            if status == "PENDING":
-                record_funnel_event("payment_pending", user_id=user_id)
-            else:
-                try:
-                    redis.srem(PIX_PENDING_SET, str(user_id))
-                except Exception:
-                    pass
-                record_funnel_event("payment_failed", user_id=user_id, gateway_status=status)
 
         return {"received": True}
     except Exception as e:
         log("[MANGOFY CALLBACK] ERRO", type(e).__name__, str(e))
+        await _forget_delivery(idem)
         return {"received": True, "error": str(e)}
 
 
@@ -1382,6 +1760,6 @@ async def mangofy_callback(request: Request):
 @app.post("/amplopay/callback")
 @app.get("/amplopay/callback")
 @app.head("/amplopay/callback")
-async def amplopay_callback_legacy(request: Request):
+async def amplopay_callback_legacy(request: Request, background_tasks: BackgroundTasks):
     """Redireciona para o handler Mangofy (compatibilidade)."""
-    return await mangofy_callback(request)
+    return await mangofy_callback(request, background_tasks)
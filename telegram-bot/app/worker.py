@@ -1,6 +1,7 @@
 import asyncio
-import json
+import time
 
+import orjson
 from aiogram import Bot, Dispatcher
 from aiogram.types import Update
 
@@ -15,10 +16,15 @@ from .config import (
 )
 from .bot_handlers import router
 from .campaign import campaign_due_loop
-from .redis_client import redis
-from .pix_payment import PIX_PENDING_SET, check_payment_status
+from .redis_client import aredis_raw, redis
+from .pix_payment import (
+    PIX_PENDING_ZSET,
+    check_payment_status,
+    migrate_legacy_pending,
+    next_poll_delay,
+)
 from .campaign import mark_paid
-from .tracking import get_utms, send_facebook_event, send_to_utmify_order, process_utmify_retries
+from .tracking import get_utms, send_paid_tracking, process_utmify_retries
 from .config import (
     DEFAULT_CLIENT_DOCUMENT,
     DEFAULT_CLIENT_EMAIL,
@@ -61,13 +67,13 @@ async def run_worker():
                 try:
                     user_id = int(uid)
                 except ValueError:
-                    redis.srem(PIX_PENDING_SET, uid)
+                    redis.zrem(PIX_PENDING_ZSET, uid)
                     return
                 status = await check_payment_status(user_id)
                 if status == "OK":
                     # mark paid & stop followups
                     mark_paid(user_id)
-                    redis.srem(PIX_PENDING_SET, uid)
+                    redis.zrem(PIX_PENDING_ZSET, uid)
                     # notify user
                     chat_id = redis.hget(f"tg:user:{user_id}", "chat_id")
                     if chat_id:
@@ -76,13 +82,13 @@ async def run_worker():
                     # tracking paid (if webhook failed)
                     try:
                         utms = get_utms(user_id)
-                        amount_str = redis.hget(f"tg:pix:{user_id}", "amount") or "0"
-                        amount = float(amount_str)
-                        identifier = redis.hget(f"tg:pix:{user_id}", "identifier") or ""
-                        await send_to_utmify_order(
+                        amount_str, identifier = redis.hmget(f"tg:pix:{user_id}", "amount", "identifier")
+                        amount = float(amount_str or "0")
+                        identifier = identifier or ""
+                        await send_paid_tracking(
                             order_id=identifier,
-                            status="paid",
                             amount=amount,
+                            currency="GBP",
                             customer={
                                 "name": DEFAULT_CLIENT_NAME or "",
                                 "email": DEFAULT_CLIENT_EMAIL or "",
@@ -90,38 +96,40 @@ async def run_worker():
                                 "document": DEFAULT_CLIENT_DOCUMENT or "",
                             },
                             utms=utms,
+                            log_tag="[POLL]",
                             platform="Telegram-UK",
                             payment_method="credit_card",
                         )
-                        await send_facebook_event(
-                            event_name="Purchase",
-                            event_id=identifier,
-                            amount=amount,
-                            currency="GBP",
-                            customer={
-                                "name": DEFAULT_CLIENT_NAME or "",
-                                "email": DEFAULT_CLIENT_EMAIL or "",
-                                "phone": DEFAULT_CLIENT_PHONE or "",
-                                "document": DEFAULT_CLIENT_DOCUMENT or "",
-                            },
-                            utms=utms,
-                        )
                         log("[POLL] paid tracking sent", {"user_id": user_id, "identifier": identifier})
                     except Exception as e:
                         log("[POLL] tracking erro", type(e).__name__, str(e))
                 elif status and status not in ("PENDING", "WAITING_PAYMENT"):
                     # status terminal (failed/canceled/expired): remove da fila pendente
-                    redis.srem(PIX_PENDING_SET, uid)
+                    redis.zrem(PIX_PENDING_ZSET, uid)
                     record_funnel_event("payment_failed", user_id=user_id, gateway_status=str(status))
+                else:
+                    # ainda pendente (ou gateway sem resposta): reagenda com backoff
+                    created_at = redis.hget(f"tg:pix:{user_id}", "created_at")
+                    redis.zadd(PIX_PENDING_ZSET, {uid: time.time() + next_poll_delay(created_at)}, xx=True)
 
+        # ZSET por próxima consulta: só pega quem já venceu o backoff (mais antigos primeiro).
         while True:
             try:
-                user_ids = list(redis.smembers(PIX_PENDING_SET))[:50]
+                # Deploy do web e do worker é separado: enquanto houver web antigo dando
+                # SADD no SET legado, migra a cada rodada (SMEMBERS vazio = 1 comando barato).
+                try:
+                    migrated = migrate_legacy_pending()
+                    if migrated:
+                        log("[POLL] pendentes migrados para o ZSET", migrated)
+                except Exception as e:
+                    log("[POLL] migração erro", type(e).__name__, str(e))
+                user_ids = redis.zrangebyscore(PIX_PENDING_ZSET, "-inf", time.time(), start=0, num=50)
                 if not user_ids:
-                    await asyncio.sleep(15)
+                    await asyncio.sleep(5)
                     continue
                 await asyncio.gather(*(process_pending_user(uid) for uid in user_ids))
-                await asyncio.sleep(20)
+                if len(user_ids) < 50:
+                    await asyncio.sleep(5)
             except Exception as e:
                 log("[POLL] erro", type(e).__name__, str(e))
                 await asyncio.sleep(20)
@@ -139,22 +147,34 @@ async def run_worker():
 
     asyncio.create_task(retry_utmify())
 
-    update_sem = asyncio.Semaphore(max(1, WORKER_MAX_CONCURRENT_UPDATES))
-    in_flight: set[asyncio.Task] = set()
+    max_updates = max(1, WORKER_MAX_CONCURRENT_UPDATES)
+    update_sem = asyncio.Semaphore(max_updates)
+    # Só referência forte contra GC das tasks; varrido em lote em vez de callback por task.
+    in_flight: list[asyncio.Task] = []
+    running = 0
 
-    async def process_update(raw: str):
+    async def process_update(raw: bytes):
+        nonlocal running
         try:
-            data = json.loads(raw)
+            data = orjson.loads(raw)
             update = Update.model_validate(data)
             await dp.feed_update(bot, update)
         except Exception as e:
             log("[WORKER] update erro", type(e).__name__, str(e))
         finally:
+            running -= 1
             update_sem.release()
 
+    def dispatch(raw: bytes):
+        nonlocal running, in_flight
+        running += 1
+        in_flight.append(asyncio.create_task(process_update(raw)))
+        if len(in_flight) >= 2 * max_updates:
+            in_flight = [t for t in in_flight if not t.done()]
+
     while True:
-        # BLPOP síncrono em thread para não travar event loop.
-        item = await asyncio.to_thread(redis.blpop, QUEUE_KEY, WORKER_QUEUE_BLPOP_TIMEOUT)
+        # BLPOP no client asyncio: espera a fila sem ocupar thread nem travar o event loop.
+        item = await aredis_raw.blpop(QUEUE_KEY, timeout=WORKER_QUEUE_BLPOP_TIMEOUT)
         if not item:
             await asyncio.sleep(0.01)
             continue
@@ -162,9 +182,16 @@ async def run_worker():
         _, raw = item
         # Backpressure real: só cria nova task quando há slot livre.
         await update_sem.acquire()
-        task = asyncio.create_task(process_update(raw))
-        in_flight.add(task)
-        task.add_done_callback(in_flight.discard)
+        dispatch(raw)
+
+        # Fila quente: drena até os slots livres num único LPOP com count (Redis 6.2+).
+        free = max_updates - running
+        if free <= 0:
+            continue
+        extra = await aredis_raw.lpop(QUEUE_KEY, free)
+        for raw in extra or ():
+            await update_sem.acquire()
+            dispatch(raw)
 
 
 if __name__ == "__main__":
@@ -31,86 +31,83 @@ def setup_webhook():
     print(f"   Secret Token: {webhook_secret[:5]}...{webhook_secret[-3:]}")
     print()
 
-    # Primeiro, remove webhook antigo (se existir)
-    print("🗑️  Removendo webhook antigo...")
-    try:
-        resp = httpx.post(
-            f"https://api.telegram.org/bot{bot_token}/deleteWebhook",
-            json={"drop_pending_updates": True},
-            timeout=10.0,
-        )
-        if resp.status_code == 200:
-            print("   ✅ Webhook antigo removido")
-        else:
-            print(f"   ⚠️  Resposta: {resp.text}")
-    except Exception as e:
-        print(f"   ⚠️  Erro ao remover webhook: {e}")
-
-    print()
-
-    # Configura novo webhook
-    print("📡 Configurando novo webhook...")
-    try:
-        resp = httpx.post(
-            f"https://api.telegram.org/bot{bot_token}/setWebhook",
-            json={
-                "url": webhook_url,
-                "secret_token": webhook_secret,
-                "drop_pending_updates": False,
-                "allowed_updates": ["message", "callback_query"],
-            },
-            timeout=10.0,
-        )
-
-        if resp.status_code == 200:
-            data = resp.json()
-            if data.get("ok"):
-                print("   ✅ Webhook configurado com sucesso!")
-                print()
-                print("📊 Informações do webhook:")
-                print(f"   URL: {webhook_url}")
-                print(f"   Secret Token: configurado")
-                print(f"   Allowed Updates: message, callback_query")
+    # Um único client para as três chamadas: reaproveita a conexão TLS com a API.
+    with httpx.Client(base_url=f"https://api.telegram.org/bot{bot_token}", timeout=10.0) as client:
+        # Primeiro, remove webhook antigo (se existir)
+        print("🗑️  Removendo webhook antigo...")
+        try:
+            resp = client.post(
+                "/deleteWebhook",
+                json={"drop_pending_updates": True},
+            )
+            if resp.status_code == 200:
+                print("   ✅ Webhook antigo removido")
+            else:
+                print(f"   ⚠️  Resposta: {resp.text}")
+        except Exception as e:
+            print(f"   ⚠️  Erro ao remover webhook: {e}")
+
+        print()
+
+        # Configura novo webhook
+        print("📡 Configurando novo webhook...")
+        try:
+            resp = client.post(
+                "/setWebhook",
+                json={
+                    "url": webhook_url,
+                    "secret_token": webhook_secret,
+                    "drop_pending_updates": False,
+                    "allowed_updates": ["message", "callback_query"],
+                },
+            )
+
+            if resp.status_code == 200:
+                data = resp.json()
+                if data.get("ok"):
+                    print("   ✅ Webhook configurado com sucesso!")
+                    print()
+                    print("📊 Informações do webhook:")
+                    print(f"   URL: {webhook_url}")
+                    print(f"   Secret Token: configurado")
+                    print(f"   Allowed Updates: message, callback_query")
+                else:
+                    print(f"   ❌ Erro: {data.get('description', 'Erro desconhecido')}")
+                    sys.exit(1)
             else:
-                print(f"   ❌ Erro: {data.get('description', 'Erro desconhecido')}")
+                print(f"   ❌ Código HTTP: {resp.status_code}")
+                print(f"   Resposta: {resp.text}")
                 sys.exit(1)
-        else:
-            print(f"   ❌ Código HTTP: {resp.status_code}")
-            print(f"   Resposta: {resp.text}")
+        except Exception as e:
+            print(f"   ❌ Erro: {e}")
             sys.exit(1)
-    except Exception as e:
-        print(f"   ❌ Erro: {e}")
-        sys.exit(1)
-
-    print()
 
-    # Verifica webhook configurado
-    print("🔍 Verificando webhook...")
-    try:
-        resp = httpx.get(
-            f"https://api.telegram.org/bot{bot_token}/getWebhookInfo",
-            timeout=10.0,
-        )
-        if resp.status_code == 200:
-            data = resp.json()
-            if data.get("ok"):
-                result = data.get("result", {})
-                print("   ✅ Status do webhook:")
-                print(f"      URL: {result.get('url', 'N/A')}")
-                print(f"      Pending updates: {result.get('pending_update_count', 0)}")
-                print(f"      Max connections: {result.get('max_connections', 40)}")
-                print(f"      IP: {result.get('ip_address', 'N/A')}")
+        print()
+
+        # Verifica webhook configurado
+        print("🔍 Verificando webhook...")
+        try:
+            resp = client.get("/getWebhookInfo")
+            if resp.status_code == 200:
+                data = resp.json()
+                if data.get("ok"):
+                    result = data.get("result", {})
+                    print("   ✅ Status do webhook:")
+                    print(f"      URL: {result.get('url', 'N/A')}")
+                    print(f"      Pending updates: {result.get('pending_update_count', 0)}")
+                    print(f"      Max connections: {result.get('max_connections', 40)}")
+                    print(f"      IP: {result.get('ip_address', 'N/A')}")
                 
-                last_error = result.get("last_error_message")
-                if last_error:
-                    print(f"      ⚠️ Último erro: {last_error}")
-                    print(f"         Data: {result.get('last_error_date', 'N/A')}")
+                    last_error = result.get("last_error_message")
+                    if last_error:
+                        print(f"      ⚠️ Último erro: {last_error}")
+                        print(f"         Data: {result.get('last_error_date', 'N/A')}")
+                else:
+                    print(f"   ❌ Erro: {data.get('description', 'Erro desconhecido')}")
             else:
-                print(f"   ❌ Erro: {data.get('description', 'Erro desconhecido')}")
-        else:
-            print(f"   ❌ Código HTTP: {resp.status_code}")
-    except Exception as e:
-        print(f"   ❌ Erro: {e}")
+                print(f"   ❌ Código HTTP: {resp.status_code}")
+        except Exception as e:
+            print(f"   ❌ Erro: {e}")
 
     print()
     print("✅ Configuração concluída!")